@@ -0,0 +1,87 @@
+"""
+Compares cache hits of pages stored uncompressed and gzipped again by
+GZipMiddleware with pages stored compressed by CustomUpdateCacheMiddleware
+(settings.CACHE_MIDDLEWARE_COMPRESS). Reports the stored size and the CPU
+time per hit.
+
+    python benchmarks/compressed_cache.py
+"""
+import pickle
+import random
+import timeit
+
+from django.conf import settings
+settings.configure(
+    ALLOWED_HOSTS=['*'],
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+)
+
+import django
+django.setup()
+
+from django.http import HttpResponse
+from django.middleware.gzip import GZipMiddleware
+from django.test import RequestFactory
+from django.test.utils import override_settings
+
+from protecomp.middleware.cache import (
+    COMPRESSORS, CustomFetchFromCacheMiddleware, CustomUpdateCacheMiddleware,
+)
+
+WORDS = ('cache', 'page', 'article', 'news', 'product', 'price', 'order',
+         'customer', 'support', 'download', 'contact', 'about', 'service')
+
+
+def page(size):
+    rows = []
+    while sum(len(row) for row in rows) < size:
+        rows.append('<li class="item-%d"><a href="/%s/%d/">%s</a></li>\n' % (
+            random.randint(0, 50), random.choice(WORDS), random.randint(0, 10000),
+            ' '.join(random.choice(WORDS) for _ in range(random.randint(3, 12)))))
+    return '<html><body><ul>\n%s</ul></body></html>' % ''.join(rows)
+
+
+def setup(content, encodings, path):
+    with override_settings(CACHE_MIDDLEWARE_COMPRESS=encodings):
+        update = CustomUpdateCacheMiddleware()
+        fetch = CustomFetchFromCacheMiddleware()
+    request = RequestFactory().get(path)
+    fetch.process_request(request)
+    update.process_response(request, HttpResponse(content))
+    stored = fetch.cache.get(update.key_builder.get(request, update.key_prefix, 'GET', update.cache))
+    return fetch, len(pickle.dumps(stored, pickle.HIGHEST_PROTOCOL))
+
+
+def hit(fetch, path, accept_encoding):
+    gzip = GZipMiddleware()
+
+    def func():
+        request = RequestFactory().get(path, HTTP_ACCEPT_ENCODING=accept_encoding)
+        gzip.process_response(request, fetch.process_request(request))
+    return func
+
+
+def main():
+    random.seed(0)
+    number = 50
+    for size in (50 * 1024, 200 * 1024):
+        content = page(size)
+        print '%d KB page:' % (size // 1024)
+        plain, plain_size = setup(content, (), '/plain/%d' % size)
+        print '    %-32s %8d bytes stored %8.1f usec/hit' % (
+            'uncompressed + GZip', plain_size,
+            min(timeit.repeat(hit(plain, '/plain/%d' % size, 'gzip'), number=number, repeat=3)) / number * 1e6)
+        for encoding in ('gzip', 'br', 'zstd'):
+            if encoding not in COMPRESSORS:
+                print '    %-32s not available' % encoding
+                continue
+            path = '/%s/%d' % (encoding, size)
+            fetch, stored_size = setup(content, (encoding,), path)
+            for accept in (encoding, 'identity'):
+                print '    %-32s %8d bytes stored %8.1f usec/hit' % (
+                    '%s stored, accepts %s' % (encoding, accept), stored_size,
+                    min(timeit.repeat(hit(fetch, path, accept), number=number, repeat=3)) / number * 1e6)
+
+
+if __name__ == '__main__':
+    main()
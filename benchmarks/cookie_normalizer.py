@@ -0,0 +1,74 @@
+"""
+Compares the per-request cost of CookieNormalizer with the old STRIP_RE
+substitution of CustomUpdateCacheMiddleware on 2-4 KB cookie headers.
+
+    python benchmarks/cookie_normalizer.py
+"""
+import random
+import re
+import string
+import timeit
+
+from django.conf import settings
+settings.configure()
+
+from protecomp.middleware.cache import CookieNormalizer
+
+STRIP_RE = re.compile(r'\b((_|ki|2c)[^=]+=.+?(?:; |$))')
+
+ANALYTICS = ('_ga', '_gid', '_gat', '_fbp', '_hjid', '_hjIncludedInSample',
+             '_gcl_au', '__utma', '__utmb', '__utmc', '__utmz', 'kimchi_uid',
+             '2c_visitor', '_uetsid', '_uetvid', '_clck', '_clsk')
+
+
+def value(length):
+    return ''.join(random.choice(string.ascii_letters + string.digits + '.-')
+                   for _ in range(length))
+
+
+def header(size):
+    cookies = [('sessionid', value(32)), ('csrftoken', value(32))]
+    cookies += [(name, value(random.randint(20, 60))) for name in ANALYTICS]
+    n = 0
+    while len('; '.join('%s=%s' % c for c in cookies)) < size:
+        cookies.append(('_ab_test_%d' % n, value(random.randint(40, 200))))
+        n += 1
+    random.shuffle(cookies)
+    return '; '.join('%s=%s' % c for c in cookies)
+
+
+def main():
+    random.seed(0)
+    number = 2000
+    for size in (2048, 3072, 4096):
+        headers = [header(size) for _ in range(50)]
+        normalizer = CookieNormalizer(deny=('_*', 'ki*', '2c*'))
+        allow = CookieNormalizer(allow=('sessionid', 'csrftoken'))
+
+        def regex():
+            for h in headers:
+                STRIP_RE.sub('', h)
+
+        def cold():
+            normalizer._memo.clear()
+            for h in headers:
+                normalizer.normalize(h)
+
+        def warm():
+            for h in headers:
+                normalizer.normalize(h)
+
+        def allowlist():
+            allow._memo.clear()
+            for h in headers:
+                allow.normalize(h)
+
+        print '%d byte headers, usec per request:' % size
+        for name, func in (('STRIP_RE.sub', regex), ('denylist, cold memo', cold),
+                           ('denylist, warm memo', warm), ('allowlist, cold memo', allowlist)):
+            seconds = min(timeit.repeat(func, number=number // 50, repeat=3))
+            print '    %-22s %8.2f' % (name, seconds / (number // 50) / len(headers) * 1e6)
+
+
+if __name__ == '__main__':
+    main()
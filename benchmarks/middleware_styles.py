@@ -0,0 +1,74 @@
+"""
+Compares requests per second through the protecomp middlewares installed
+old-style in MIDDLEWARE_CLASSES and new-style in MIDDLEWARE, for cache hits
+and for uncacheable requests rendered by the view.
+
+    python benchmarks/middleware_styles.py
+"""
+import timeit
+
+from django.conf import settings
+settings.configure(
+    ALLOWED_HOSTS=['*'],
+    ROOT_URLCONF=__name__,
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    CACHE_MIDDLEWARE_SECONDS=600,
+    SECURE_REQUIRED_PATHS=('/admin/', '/account/'),
+    HTTPS_SUPPORT=True,
+)
+
+import django
+django.setup()
+
+from django.conf.urls import url
+from django.core.handlers.base import BaseHandler
+from django.http import HttpResponse
+from django.test import RequestFactory
+from django.test.utils import override_settings
+
+STACK = [
+    'protecomp.middleware.timing.ServerTimingMiddleware',
+    'protecomp.middleware.cache.CustomUpdateCacheMiddleware',
+    'protecomp.middleware.security.SecureRequiredMiddleware',
+    'protecomp.middleware.cache.CsrfTokenUpdaterMiddleware',
+    'protecomp.middleware.profiler.ProfilerMiddleware',
+    'protecomp.middleware.cache.CustomFetchFromCacheMiddleware',
+]
+
+
+def page(request):
+    return HttpResponse('<html>%s</html>' % ('x' * 2000))
+
+
+def private(request):
+    response = HttpResponse('<html>%s</html>' % ('x' * 2000))
+    response['Cache-Control'] = 'private, max-age=0'
+    return response
+
+
+urlpatterns = [
+    url(r'^page/$', page),
+    url(r'^private/$', private),
+]
+
+
+def measure(name, **middleware):
+    with override_settings(**middleware):
+        handler = BaseHandler()
+        handler.load_middleware()
+        factory = RequestFactory()
+        for path in ('/page/', '/private/'):
+            handler.get_response(factory.get(path))
+            number = 5000
+            seconds = min(timeit.repeat(lambda: handler.get_response(factory.get(path)),
+                                        number=number, repeat=3))
+            print '%-20s %-10s %8.0f requests/s' % (name, path, number / seconds)
+
+
+def main():
+    measure('MIDDLEWARE_CLASSES', MIDDLEWARE=None, MIDDLEWARE_CLASSES=STACK)
+    measure('MIDDLEWARE', MIDDLEWARE=STACK)
+
+
+if __name__ == '__main__':
+    main()
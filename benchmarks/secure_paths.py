@@ -0,0 +1,54 @@
+"""
+Compares PathPrefixMatcher with the linear startswith scan SecureRequiredMiddleware
+used before, for a growing number of SECURE_REQUIRED_PATHS prefixes.
+
+    python benchmarks/secure_paths.py
+"""
+import random
+import string
+import timeit
+
+from django.conf import settings
+settings.configure()
+
+from protecomp.middleware.security import PathPrefixMatcher
+
+
+def segment():
+    return ''.join(random.choice(string.ascii_lowercase) for _ in range(random.randint(3, 10)))
+
+
+def main():
+    random.seed(0)
+    sections = [segment() for _ in range(20)]
+    for count in (10, 100, 1000):
+        prefixes = ['/%s/%s/' % (random.choice(sections), segment()) for _ in range(count)]
+        # Half of the paths match a prefix, the rest only share the first segment
+        paths = ['%s%s/%s/' % (random.choice(prefixes), segment(), segment()) for _ in range(100)]
+        paths += ['/%s/%s/%s/' % (random.choice(sections), segment(), segment()) for _ in range(100)]
+
+        def linear():
+            for path in paths:
+                for prefix in prefixes:
+                    if path.startswith(prefix):
+                        break
+
+        matcher = PathPrefixMatcher(prefixes)
+
+        def cold():
+            matcher._memo.clear()
+            for path in paths:
+                matcher.match(path)
+
+        def warm():
+            for path in paths:
+                matcher.match(path)
+
+        print '%d prefixes, usec per request:' % count
+        for name, func in (('startswith scan', linear), ('matcher, cold memo', cold), ('matcher, warm memo', warm)):
+            seconds = min(timeit.repeat(func, number=20, repeat=3))
+            print '    %-20s %8.2f' % (name, seconds / 20 / len(paths) * 1e6)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Measures the overhead of the protecomp.middleware.timing instrumentation,
+with timing off (ServerTimingMiddleware not installed) and on.
+
+    python benchmarks/timing_overhead.py
+"""
+import timeit
+
+from django.conf import settings
+settings.configure(
+    ALLOWED_HOSTS=['*'],
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+)
+
+import django
+django.setup()
+
+from django.http import HttpResponse
+from django.test import RequestFactory
+
+from protecomp.middleware import timing
+from protecomp.middleware.cache import (
+    CsrfTokenUpdaterMiddleware, CustomFetchFromCacheMiddleware, CustomUpdateCacheMiddleware,
+)
+
+
+def main():
+    number = 100000
+    request = RequestFactory().get('/')
+
+    def empty():
+        pass
+
+    def phase():
+        started = timing.start()
+        timing.record(request, 'phase', started)
+
+    update = CustomUpdateCacheMiddleware()
+    fetch = CustomFetchFromCacheMiddleware()
+    csrf = CsrfTokenUpdaterMiddleware()
+    warm = RequestFactory().get('/page', HTTP_COOKIE='_ga=1; sessionid=abc')
+    update.process_request(warm)
+    fetch.process_request(warm)
+    update.process_response(warm, HttpResponse('<html>%s</html>' % ('x' * 10000)))
+
+    def hit():
+        request = RequestFactory().get('/page', HTTP_COOKIE='_ga=1; sessionid=abc')
+        request.META['CSRF_COOKIE'] = 'a' * 32
+        update.process_request(request)
+        response = fetch.process_request(request)
+        update.process_response(request, csrf.process_response(request, response))
+
+    def measure(func, number):
+        return min(timeit.repeat(func, number=number, repeat=5)) / number * 1e9
+
+    baseline = measure(empty, number)
+    print 'nsec per phase (empty function call %.0f nsec subtracted):' % baseline
+    timing.enabled = False
+    print '    %-10s %8.0f' % ('off', measure(phase, number) - baseline)
+    timing.enabled = True
+    print '    %-10s %8.0f' % ('on', measure(phase, number) - baseline)
+
+    print 'usec per cache hit through the middlewares (4 phases):'
+    for enabled in (False, True):
+        timing.enabled = enabled
+        print '    %-10s %8.1f' % ('on' if enabled else 'off', measure(hit, 2000) / 1000)
+
+
+if __name__ == '__main__':
+    main()
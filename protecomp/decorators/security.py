@@ -1,13 +1,13 @@
 from django.conf import settings
 from django.http import HttpResponseRedirect
 
+from protecomp.middleware.security import secure_url
+
 def secure_required(view_func):
     """Decorator makes sure URL is accessed over https."""
     def _wrapped_view_func(request, *args, **kwargs):
         if not request.is_secure():
             if getattr(settings, 'HTTPS_SUPPORT', False):
-                request_url = request.build_absolute_uri(request.get_full_path())
-                secure_url = request_url.replace('http://', 'https://')
-                return HttpResponseRedirect(secure_url)
+                return HttpResponseRedirect(secure_url(request))
         return view_func(request, *args, **kwargs)
-    return _wrapped_view_func
\ No newline at end of file
+    return _wrapped_view_func
@@ -11,8 +11,19 @@ The rest are relative to the remote_base path
 - env.virtualenv, path to virtual environment root
 - env.manage, path to manage.py -file
 - env.pip_requirements, path to pip requirements-file
+
+The update, checkout, revision, status and reload tasks run on all hosts at
+once after the in_parallel task, see protecomp.fabric.parallel.
 """
+from collections import Counter
+from io import BytesIO
+import hashlib
+import json
 import os
+import re
+import shutil
+import tempfile
+from pipes import quote
 
 from fabric.api import *
 from fabric.api import run, env, cd
@@ -20,32 +31,63 @@ from fabric.context_managers import hide
 from fabric.contrib.console import confirm
 from fabric.contrib.files import exists, sed
 
-from . import util
+from . import static, util, warm
+from .timing import compare_deploy, timed
+from .parallel import multihost, in_parallel, print_result, report, run_on_hosts
 
 from distutils.util import strtobool
+import time
+
+# Prints "path<TAB>vcs<TAB>branch<TAB>revision" for each path, vcs is empty
+# for unsupported revision control systems
+REVISION_PROBE = r"""
+for path in %s; do
+    if [ -d "$path/.git" ]; then
+        branch=$(cd "$path" && (git symbolic-ref -q --short HEAD || echo "($(git rev-parse --short HEAD)...)"))
+        printf '%%s\tgit\t%%s\t%%s\n' "$path" "$branch" "$(cd "$path" && git rev-parse HEAD | cut -c1-8)"
+    elif [ -d "$path/.hg" ]; then
+        printf '%%s\thg\t%%s\t%%s\n' "$path" "$(hg -R "$path" branch)" "$(hg -R "$path" parent --template '{rev}:{node|short}')"
+    else
+        printf '%%s\t\t\t\n' "$path"
+    fi
+done
+"""
 
-def revision_for_path(path):
+def revisions_for_paths(paths):
+    """Get the revision control system, branch and revision of the repositories
+    in paths with a single remote command.
+
+    Returns a dict of path: (vcs, branch, revision), all False if the path
+    is not a git or mercurial repository.
+    """
+    paths = list(paths)
+    if not paths:
+        return {}
     with settings(
-            cd(path),
             hide('stdout', 'running'),
             warn_only=True,
         ):
-        # Strange-looking commands with ||, this prevents unneeded errors when exit status is != 0
-        if run('test -d .git || echo "failed"') != 'failed':
-            # __git_ps1 gives nicely formatted output in all circumstances,
-            # but might not be available in all systems.
-            branch_cmd = "source /etc/bash_completion.d/git*; __git_ps1 '%s'"
-            branch = run(branch_cmd)
-            rev = run('git rev-parse HEAD')
-            if len(rev) > 8: rev = rev[:8]
-        elif run('test -d .hg || echo "failed"') != 'failed':
-            log = run('hg parent')
-            parts = log.split('\n')
-            rev = parts[0].split(" ")[-1]
-            branch = run('hg branch').strip()
-        else:
-            return (False, False)
-    return (branch, rev)
+        output = run(REVISION_PROBE % ' '.join(quote(path) for path in paths))
+    return _parse_revisions(paths, output)
+
+def local_revision(path):
+    """Get (vcs, branch, revision) of the local repository in path, see
+    revisions_for_paths"""
+    with settings(hide('running'), warn_only=True):
+        output = local(REVISION_PROBE % quote(path), capture=True)
+    return _parse_revisions([path], output)[path]
+
+def _parse_revisions(paths, output):
+    revisions = dict((path, (False, False, False)) for path in paths)
+    for line in output.splitlines():
+        path, vcs, branch, rev = (line.rstrip('\r').split('\t') + ['', '', ''])[:4]
+        if path in revisions and vcs:
+            revisions[path] = (vcs, branch.strip(), rev.strip())
+    return revisions
+
+def revision_for_path(path):
+    """Get (branch, revision) of the repository in path"""
+    return revisions_for_paths([path])[path][1:]
 
 @roles('code')
 def get_revision(output_level=2):
@@ -62,32 +104,132 @@ def get_revision(output_level=2):
 
 @roles('code')
 @task
+@multihost
+@timed
 def revision(*args):
     """Show revision and branch for all repositories on the server, or only the specified ones"""
     host = env.host.split('.', 1)[0]
     packages = args if args else env.repository_roots.keys()
 
+    revisions = revisions_for_paths(env.repository_roots[package] for package in packages)
     for package in packages:
-        (branch, rev) = revision_for_path(env.repository_roots[package])
+        (vcs, branch, rev) = revisions[env.repository_roots[package]]
         print "%s:\t{0:28} {1}".format("%s:%s" % (package, branch), rev) % host
 
+def _requirements_paths():
+    return (
+        os.path.join(env.remote_base, env.virtualenv, 'bin/activate'),
+        os.path.join(env.remote_base, env.pip_requirements),
+        os.path.join(env.remote_base, env.virtualenv, '.requirements-sha1'),
+        os.path.join(env.remote_base, env.get('wheelhouse', 'wheelhouse')),
+    )
+
+def _requirements_state():
+    """Return (hash of the requirements file, hash of the last install)"""
+    activate, pip_requirements, marker, wheelhouse = _requirements_paths()
+    with settings(hide('stdout', 'running'), warn_only=True):
+        output = run('echo "requirements=$(sha1sum %s | cut -c1-40)"; echo "installed=$(cat %s 2>/dev/null)"' % (
+            pip_requirements, marker))
+    state = dict(line.strip().split('=', 1) for line in output.splitlines() if '=' in line)
+    if not state.get('requirements'):
+        abort("%s:\t Cannot read %s" % (env.host, pip_requirements))
+    return state['requirements'], state.get('installed', '')
+
+def _install_wheels(archive, builder, requirements_hash):
+    activate, pip_requirements, marker, wheelhouse = _requirements_paths()
+    with settings(cd(env.remote_base), hide('stdout', 'running')):
+        if env.host_string != builder:
+            remote_archive = run('mktemp')
+            put(archive, remote_archive)
+            run('rm -rf %s && mkdir -p %s && tar -xzf %s -C %s; status=$?; rm -f %s; exit $status' % (
+                wheelhouse, wheelhouse, remote_archive, wheelhouse, remote_archive))
+        run('source %s; pip install --no-index --find-links %s -r %s' % (activate, wheelhouse, pip_requirements))
+        run('echo %s > %s' % (requirements_hash, marker))
+    print "%s:\t Installed requirements %s" % (env.host, requirements_hash[:8])
+
 @roles('app-server')
 @task
-def update_requirements():
-    """Run pip install on remote machine to update python libraries"""
-    activate = os.path.join(env.remote_base, env.virtualenv, 'bin/activate')
-    pip_requirements = os.path.join(env.remote_base, env.pip_requirements)
+@runs_once
+@timed
+def update_requirements(force='false'):
+    """Run pip install on remote machines to update python libraries
+
+Skips the hosts where the sha1 of env.pip_requirements matches the last
+successful install. The wheels are built once, on the first host to update,
+into env.wheelhouse (default 'wheelhouse', relative to env.remote_base),
+reusing the wheels of the previous build, and copied to the other hosts,
+which install them in parallel without an index. The wheelhouse holds only
+the wheels of the current requirements.
+The hosts are expected to share the platform. Files included from the
+requirements file with -r are not hashed, use force=true after changing them.
 
-    print "Updating pip-requirements..."
-    with settings(
-            cd(env.remote_base),
-            hide('stdout', 'running'),
-            ):
-        run('source %s; pip install -r %s' % (activate, pip_requirements))
+examples:
+
+    update_requirements:force=true
+    - install even if the requirements file has not changed
+    """
+    force = bool(strtobool(str(force)))
+    hosts = env.all_hosts
+    pool_size = int(env.get('parallel_pool_size') or 10)
+
+    states = run_on_hosts(_requirements_state, hosts, pool_size=pool_size)
+    if not report(states):
+        abort("Could not read the requirements on all hosts")
+    stale = [state for state in states if force or state.result[0] != state.result[1]]
+    if not stale:
+        print "Requirements unchanged on all hosts"
+        return
+
+    builder = stale[0].host
+    requirements_hash = stale[0].result[0]
+    if any(state.result[0] != requirements_hash for state in stale):
+        abort("The requirements file differs between hosts, update the code first")
+
+    print "Building wheels on %s for %d hosts..." % (builder, len(stale))
+    activate, pip_requirements, marker, wheelhouse = _requirements_paths()
+    local_dir = tempfile.mkdtemp()
+    archive = os.path.join(local_dir, 'wheelhouse.tar.gz')
+    try:
+        with settings(cd(env.remote_base), hide('stdout', 'running'), host_string=builder):
+            # Wheels built earlier are reused, but only the ones the current
+            # requirements resolve to are kept
+            run('source %s; rm -rf %s.new && pip wheel --find-links %s -w %s.new -r %s && rm -rf %s && mv %s.new %s' % (
+                activate, wheelhouse, wheelhouse, wheelhouse, pip_requirements, wheelhouse, wheelhouse, wheelhouse))
+            if len(stale) > 1:
+                remote_archive = run('mktemp')
+                run('tar -czf %s -C %s .' % (remote_archive, wheelhouse))
+                get(remote_archive, archive)
+                run('rm -f %s' % remote_archive)
+
+        results = run_on_hosts(_install_wheels, [state.host for state in stale],
+                               (archive, builder, requirements_hash), pool_size=pool_size, callback=print_result)
+    finally:
+        shutil.rmtree(local_dir)
+    if not report(results):
+        abort("Requirements were not updated on all hosts")
     print "Update finished."
 
+def git_fetch_script(paths, depth=None, filter=None):
+    """Shell script fetching the git repositories in paths concurrently, at
+    most env.git_fetch_jobs (default 4) at a time. Fails if any fetch fails.
+
+    depth makes shallow fetches, filter partial ones (e.g. 'blob:none').
+    """
+    options = ''
+    if depth:
+        options += ' --depth=%d' % int(depth)
+    if filter:
+        options += ' --filter=%s' % filter
+    return (
+        "FETCH_OPTIONS=%s; export FETCH_OPTIONS; "
+        "printf '%%s\\0' %s | xargs -0 -n 1 -P %d sh -c "
+        "'cd \"$0\" && git fetch -q --all $FETCH_OPTIONS || { echo \"Fetch failed: $0\" >&2; exit 1; }'"
+    ) % (quote(options), ' '.join(quote(path) for path in paths), int(env.get('git_fetch_jobs', 4)))
+
 @roles('code')
 @task
+@multihost
+@timed
 def update(*args):
     """Pull and update remote repositories. If argument is not given, only default repos are updated.
 
@@ -102,30 +244,42 @@ def update(*args):
     host = env.host.split('.', 1)[0]
 
     packages = args if args else env.update_default
+    update_roots = [env.repository_roots[package] for package in packages]
 
-    for package in packages:
-        update_root = env.repository_roots[package]
-
+    before = revisions_for_paths(update_roots)
+    git_roots = []
+    for package, update_root in zip(packages, update_roots):
+        (vcs, branch, rev) = before[update_root]
         print "%s:\tUpdating %s..." % (host, package)
-        print "%s:\tRevision before update:\t%s:%s" % ((host, ) + revision_for_path(update_root))
-        with settings(
-                hide('stdout', 'running'),
-                cd(update_root),
-                ):
-            if run('test -d .git || echo "failed"') != 'failed':
-                # __git_ps1 gives nicely formatted output in all circumstances,
-                # but might not be available in all systems.
-                run('git pull')
-            elif run('test -d .hg || echo "failed"') != 'failed':
+        print "%s:\tRevision before update:\t%s:%s" % (host, branch, rev)
+        if vcs == 'git':
+            git_roots.append(update_root)
+        elif vcs == 'hg':
+            with settings(
+                    hide('stdout', 'running'),
+                    cd(update_root),
+                    ):
                 run('hg pull')
                 run('hg update')
-            else:
-                print "Unsupported revision control system or wrong remote_base"
-        print "%s:\tUpdated to revision: \t%s:%s" % ((host, ) + revision_for_path(update_root))
+        else:
+            print "Unsupported revision control system or wrong remote_base"
+
+    if git_roots:
+        # Fetch all repositories at once, then fast-forward each one
+        with hide('stdout', 'running'):
+            run(git_fetch_script(git_roots) + ' && ' + ' && '.join(
+                '(cd %s && git merge -q --ff-only @{u})' % quote(update_root) for update_root in git_roots))
+
+    after = revisions_for_paths(update_roots)
+    for package, update_root in zip(packages, update_roots):
+        (vcs, branch, rev) = after[update_root]
+        print "%s:\tUpdated %s to revision: \t%s:%s" % (host, package, branch, rev)
 
 @roles('code')
 @task
-def checkout(branch, force='false', reset='false', default='master'):
+@multihost
+@timed
+def checkout(branch, force='false', reset='false', default='master', depth=None, filter=None):
     """Pull and checkout all remote repositories to a named branch, if it exists (fallback to master)
 
 examples:
@@ -139,47 +293,194 @@ examples:
     checkout:feature/my_feature,default=release
     - checkouts the branch, fallbacking to release-branch (release-branch must exist on all repos)
 
+    checkout:release,reset=true,depth=1
+    - shallow fetch, for large repositories
+
 args:
 
     branch: branch name (required)
     force: force checkout, overwriting local uncommitted changes
     reset: after checkout, hard reset to remote branch
     default: The branch to checkout if 'branch' does not exist
+    depth: fetch only this many commits from the tip of each branch, requires reset
+    filter: partial clone filter for the fetch, e.g. blob:none
     """
     host = env.host.split('.', 1)[0]
     force = bool(strtobool(str(force)))
     reset = bool(strtobool(str(reset)))
     if not branch:
         raise Exception("No branch specified")
+    if depth and not reset:
+        # The shallow history does not reach the checked out commits, so
+        # git refuses to fast-forward to it
+        abort("%s: checkout with depth requires reset=true" % host)
+
+    # One script per host: fetch all repositories concurrently, then check
+    # out the branch, or default if the branch is not found in the refs of
+    # the repository, and print "package<TAB>branch" for each repository
+    checkout_script = []
     for package, repository_root in env.repository_roots.items():
-        with settings(
-                hide('stdout', 'running'),
-                cd(repository_root),
-        ):
-            print "%s:\t Fetching %s" % (host, package)
-            run('git fetch --all')
-            if run("git branch -a | grep -e '%s$' || echo 'failed'" % branch) != 'failed':
-                branch_to_checkout = branch
-            else:
-                branch_to_checkout = default
-            print "%s:\t Checking out branch %s" % (host, branch_to_checkout)
-            args = ' --force' if force else ''
-            run("git checkout -q%s %s" % (args, branch_to_checkout))
-            if reset:
-                run("git reset --hard -q origin/%s" % branch_to_checkout)
-            else:
-                run("git merge -q --ff-only origin/%s" % branch_to_checkout)
+        checkout_script.append(
+            '(cd {root} && '
+            'if git for-each-ref --format="%(refname)" refs/heads refs/remotes/origin'
+            ' | grep -qxF -e refs/heads/{branch} -e refs/remotes/origin/{branch}; '
+            'then b={branch}; else b={default}; fi && '
+            'printf "%s\\t%s\\n" {package} "$b" && '
+            'git checkout -q{force} "$b" && '
+            '{sync} "origin/$b")'.format(
+                root=quote(repository_root),
+                branch=quote(branch),
+                default=quote(default),
+                package=quote(package),
+                force=' --force' if force else '',
+                sync='git reset --hard -q' if reset else 'git merge -q --ff-only',
+            ))
+
+    print "%s:\t Fetching %s" % (host, ', '.join(env.repository_roots.keys()))
+    with settings(hide('stdout', 'running'), warn_only=True):
+        output = run(git_fetch_script(env.repository_roots.values(), depth, filter)
+                     + ' && ' + ' && '.join(checkout_script))
+    for line in output.splitlines():
+        if '\t' in line:
+            package, branch_to_checkout = line.strip().split('\t', 1)
+            print "%s:\t Checked out %s branch %s" % (host, package, branch_to_checkout)
+    if output.failed:
+        print output
+        abort("%s: checkout failed" % host)
 
 @roles('media')
 @task
+@timed
 def collectstatic():
     """Run manage.py collectstatic script on media-server"""
     activate = os.path.join(env.remote_base, env.virtualenv, 'bin/activate')
     manage = os.path.join(env.remote_base, env.manage)
     run('source %s; python %s collectstatic --noinput' % (activate, manage))
 
+# Manifests of the local static roots built during this run
+_static_manifests = {}
+
+def _local_manifest_path(local_root):
+    # A hash cache of the local files, kept outside the static root
+    return os.path.join(tempfile.gettempdir(), 'protecomp-static-%s.json' % (
+        hashlib.sha1(os.path.abspath(local_root)).hexdigest()[:16]))
+
+def _build_static():
+    local_root = env.local_static_root
+    if local_root not in _static_manifests:
+        util.manage('collectstatic --noinput')
+        local_manifest = _local_manifest_path(local_root)
+        previous = {}
+        if os.path.exists(local_manifest):
+            with open(local_manifest) as f:
+                previous = static.load_manifest(f)
+        manifest = static.build_manifest(local_root, previous)
+        with open(local_manifest, 'w') as f:
+            json.dump(manifest, f, sort_keys=True)
+        _static_manifests[local_root] = manifest
+    return _static_manifests[local_root]
+
+# Prints the status of the working copy in the current directory, empty if
+# it has no changes
+LOCAL_CHANGES = 'if [ -d .git ]; then git status --porcelain; else hg status; fi'
+
+def _check_local_revision(host):
+    """Abort unless the local working copy in env.local_base is clean and at
+    the revision deployed in env.remote_base"""
+    local_base = env.local_base
+    vcs, branch, local_rev = local_revision(local_base)
+    deployed_vcs, deployed_branch, deployed_rev = revisions_for_paths([env.remote_base])[env.remote_base]
+    if not vcs:
+        abort("%s is not a git or mercurial working copy" % local_base)
+    if local_rev != deployed_rev:
+        abort("%s: revision %s:%s is deployed, the local working copy is at %s:%s"
+              % (host, deployed_branch, deployed_rev, branch, local_rev))
+    with settings(hide('running'), lcd(local_base)):
+        changes = local(LOCAL_CHANGES, capture=True)
+    if changes.strip():
+        abort("The local working copy has uncommitted changes:\n%s" % changes)
+
+def _check_local_requirements(host):
+    """Abort unless the requirements file in env.local_base is the one last
+    installed with update_requirements on the server"""
+    with open(os.path.join(env.local_base, env.pip_requirements), 'rb') as f:
+        requirements_hash = hashlib.sha1(f.read()).hexdigest()
+    activate, pip_requirements, marker, wheelhouse = _requirements_paths()
+    with settings(hide('stdout', 'running'), warn_only=True):
+        installed = run('cat %s 2>/dev/null' % marker).strip()
+    if installed != requirements_hash:
+        abort("%s: the installed requirements (%s) differ from the local %s (%s), run update_requirements first"
+              % (host, installed[:8] or 'unknown', env.pip_requirements, requirements_hash[:8]))
+
+@roles('media')
+@task
+@timed
+def collectstatic_incremental(force='false'):
+    """Collect static files locally and upload only the changed files to media-server
+
+Runs manage.py collectstatic locally, compares the content hashes of the
+collected files with the manifest uploaded on the previous run and extracts
+the changed files over env.static_root from a single archive. Files removed
+locally are left in place on the server, as with collectstatic.
+
+The local working copy in env.local_base must be clean and at the revision
+checked out on the server, and its requirements file must be the one last
+installed on the server by update_requirements, so that the files match the
+deployed code and libraries. The local virtualenv is expected to be up to
+date with the requirements file. The
+manifest is kept in the virtualenv directory on the server, outside the
+served static root.
+
+examples:
+
+    collectstatic_incremental
+    collectstatic_incremental:force=true
+    - skip the checks of the local working copy and requirements
+
+setup:
+
+    env.local_base = '/path/to/local/project', the local working copy
+    env.local_static_root = '/path/to/local/STATIC_ROOT'
+    env.static_root = 'static', relative to env.remote_base
+    """
+    host = env.host.split('.', 1)[0]
+    local_root = env.local_static_root
+    remote_root = os.path.join(env.remote_base, env.static_root)
+    remote_manifest = os.path.join(env.remote_base, env.virtualenv, static.MANIFEST_NAME)
+
+    if not bool(strtobool(str(force))):
+        _check_local_revision(host)
+        _check_local_requirements(host)
+    manifest = _build_static()
+    deployed = BytesIO()
+    with hide('stdout', 'running'):
+        if exists(remote_manifest):
+            get(remote_manifest, deployed)
+    deployed.seek(0)
+    changed, removed = static.diff_manifests(static.load_manifest(deployed), manifest)
+
+    if not changed:
+        print "%s:\t Static files up to date" % host
+        return
+
+    print "%s:\t Uploading %d changed files (%d removed locally)" % (host, len(changed), len(removed))
+    with tempfile.TemporaryFile() as archive:
+        static.write_archive(local_root, changed, archive)
+        archive.seek(0)
+        with hide('stdout', 'running'):
+            remote_archive = run('mktemp')
+            put(archive, remote_archive)
+            # Also removes the manifest left in the static root by earlier versions
+            run('mkdir -p %s && tar -xzf %s -C %s && rm -f %s; status=$?; rm -f %s; exit $status' % (
+                quote(remote_root), remote_archive, quote(remote_root),
+                quote(os.path.join(remote_root, static.MANIFEST_NAME)), remote_archive))
+            # Written last, so that the files are uploaded again if extracting fails
+            put(BytesIO(json.dumps(manifest, sort_keys=True)), remote_manifest)
+
 @roles('code')
 @task
+@multihost
+@timed
 def status(*args):
     """Show a status for all processes
 
@@ -214,6 +515,8 @@ setup:
 
 @roles('code')
 @task
+@multihost
+@timed
 def reload(*args):
     """Reloads a specified process or all processes
 
@@ -236,6 +539,7 @@ setup: see status-task
 
 @roles('code')
 @task
+@timed
 def restart(*args):
     """Hard-restarts a specified process.
 
@@ -260,8 +564,106 @@ setup: see status-task
         run(command)
 
 
+def _is_healthy(process_definitions):
+    """Check env.health_check_url on the host, or the status of the processes"""
+    with settings(hide('everything'), warn_only=True):
+        url = env.get('health_check_url')
+        if url:
+            return run('curl -fsS -o /dev/null --max-time 5 %s' % quote(url % {'host': env.host})).succeeded
+        return all([run(definition['status']).succeeded for definition in process_definitions])
+
+
+def _rolling_host(command_name, process_names):
+    process_definitions = util.get_processes(env.host, process_names=process_names)
+    for process_definition in process_definitions:
+        run(process_definition[command_name])
+
+    deadline = time.time() + float(env.get('health_check_timeout', 60))
+    while not _is_healthy(process_definitions):
+        if time.time() > deadline:
+            abort("%s: not healthy after %s" % (env.host, command_name))
+        time.sleep(float(env.get('health_check_interval', 2)))
+    print "%s:\t healthy" % env.host
+
+
+def _rolling(command_name, process_names, min_capacity=None):
+    """Run the command of the processes on a batch of hosts at a time, waiting
+    for the batch to be healthy before the next one. Stops on failure, and
+    before starting if even one host at a time leaves less than min_capacity
+    percent of the hosts serving.
+    """
+    process_names = process_names or None
+    hosts = [host for host in env.all_hosts if util.get_processes(host, process_names=process_names)]
+    if not hosts:
+        print "No processes to %s" % command_name
+        return
+
+    if min_capacity is None:
+        min_capacity = env.get('rolling_min_capacity', 75)
+    batch_size = int(len(hosts) * (100 - float(min_capacity)) / 100)
+    if batch_size < 1:
+        abort("Running %s on one of the %d hosts leaves less than %s%% of them serving, lower min_capacity"
+              % (command_name, len(hosts), min_capacity))
+    batches = [hosts[i:i + batch_size] for i in range(0, len(hosts), batch_size)]
+
+    for number, batch in enumerate(batches, 1):
+        print "Batch %d/%d: %s" % (number, len(batches), ', '.join(batch))
+        results = run_on_hosts(_rolling_host, batch, (command_name, process_names),
+                               pool_size=batch_size, callback=print_result)
+        if not report(results):
+            abort("Stopped rolling %s, not run on: %s" % (
+                command_name, ', '.join(host for later in batches[number:] for host in later) or '-'))
+
+
+@roles('code')
+@task
+@runs_once
+@timed
+def rolling_reload(*args, **kwargs):
+    """Reloads processes a batch of hosts at a time, keeping the rest serving
+
+The next batch is reloaded once the hosts of the previous one are healthy.
+A host is healthy when env.health_check_url (e.g. 'http://localhost:8000/',
+may contain %(host)s) responds, or when the status commands of its
+processes succeed. Stops if a host is not healthy in
+env.health_check_timeout seconds (default 60). Refuses to start if there
+are too few hosts to keep min_capacity percent of them serving, e.g. with
+a single host use min_capacity=0.
+
+examples:
+
+    rolling_reload
+    - reload all known processes, keeping 75% of the hosts serving
+
+    rolling_reload:django,min_capacity=50
+    - reload django on half of the hosts at a time
+
+setup: see status-task, env.rolling_min_capacity sets the default capacity
+    """
+    _rolling('reload', args, kwargs.get('min_capacity'))
+
+
+@roles('code')
+@task
+@runs_once
+@timed
+def rolling_restart(*args, **kwargs):
+    """Hard-restarts processes a batch of hosts at a time, see rolling_reload
+
+examples:
+
+    rolling_restart:django,node
+    - restarts django and node processes
+    """
+    if not args:
+        print "Specify a process to restart"
+        return
+    _rolling('restart', args, kwargs.get('min_capacity'))
+
+
 @roles('media')
 @task
+@timed
 def deploy(*args):
     """Deploy all targets or a specified target
 
@@ -289,14 +691,167 @@ setup:
     for key in targets:
         execute(env.deployment[key])
 
+    if env.get('warm_cache_after_deploy'):
+        execute(warm_cache)
+
+
+@roles('app-server')
+@task
+@runs_once
+@timed
+def warm_cache(source=None, top=100, rate=10, concurrency=4, verify='true', every_host='false'):
+    """Request the most visited pages from the app servers to fill the page cache
+
+The URLs are read from env.warm_cache_sitemap, env.warm_cache_urls or the
+top URLs of env.warm_cache_access_log, the first one set unless source is
+given. They are spread over the app servers, and requested at most rate
+times a second in total. With verify, the URLs are requested again and the
+transitions of the X-Cache-Middleware states are reported, e.g. Miss -> Hit.
+
+examples:
+
+    warm_cache
+    warm_cache:source=log,top=500,rate=20
+
+setup:
+
+    env.warm_cache_base_url = 'http://%(host)s:8000', the address of an app server
+    env.warm_cache_host = 'www.example.com', Host header, default from the URLs
+    env.warm_cache_sitemap = 'https://www.example.com/sitemap.xml', or a local file
+    env.warm_cache_urls = 'warm_urls.txt', a local file of URLs or paths
+    env.warm_cache_access_log = '/var/log/nginx/access.log', on the first app server
+    env.warm_cache_after_deploy = True, to warm the cache at the end of deploy
+    """
+    top = int(top)
+    sources = (('sitemap', 'warm_cache_sitemap'), ('file', 'warm_cache_urls'), ('log', 'warm_cache_access_log'))
+    if source is None:
+        source = next((name for name, setting in sources if env.get(setting)), None)
+    if source not in dict(sources) or not env.get(dict(sources)[source]):
+        abort("Set one of env.%s" % ', env.'.join(setting for name, setting in sources))
+
+    hosts = env.all_hosts
+    location = env.get(dict(sources)[source])
+    if source == 'sitemap':
+        urls = warm.sitemap_urls(location, top)
+    elif source == 'file':
+        urls = warm.file_urls(location, top)
+    else:
+        with settings(hide('stdout', 'running'), host_string=hosts[0]):
+            urls = run(warm.ACCESS_LOG_COMMAND % (quote(location), top)).split()
+
+    base_urls = [env.warm_cache_base_url % {'host': host.split('@')[-1].split(':')[0]} for host in hosts]
+    jobs = []
+    for number, url in enumerate(urls):
+        host_header, path = warm.split_url(url)
+        if bool(strtobool(str(every_host))):
+            jobs.extend((base_url, host_header, path) for base_url in base_urls)
+        else:
+            jobs.append((base_urls[number % len(base_urls)], host_header, path))
+
+    print "Warming %d URLs on %d app servers..." % (len(urls), len(hosts))
+    started = time.time()
+    host_header = env.get('warm_cache_host')
+    first = warm.fetch_all(jobs, float(rate), concurrency, host_header)
+    print "Requested %d URLs in %.1fs" % (len(first), time.time() - started)
+
+    errors = sorted((key, result[0]) for key, result in first.items() if result[0] != 200)
+    for (base_url, path), status in errors:
+        print "\t%s%s\t%s" % (base_url, path, status)
+
+    if bool(strtobool(str(verify))):
+        second = warm.fetch_all(jobs, float(rate), concurrency, host_header)
+        print "Cache states, first -> second request:"
+        for (before, after), count in sorted(warm.transitions(first, second).items(), key=lambda item: -item[1]):
+            print "\t%-12s -> %-12s %d" % (before, after, count)
+    else:
+        updates = Counter('%s, X-Cache-Update: %s' % (result[1], result[2]) for result in first.values())
+        for state, count in updates.most_common():
+            print "\t%-40s %d" % (state, count)
+
+
+# Prints a hash of the migration files under the current directory and in
+# the virtualenv, so that the migrations of installed packages count too,
+# and the hash recorded by the last successful migrate. The static root and
+# the repository metadata are skipped.
+MIGRATION_STATE = (
+    'echo "migrations=$(find . %(virtualenv)s %(pruned)s -name .git -prune -o -name .hg -prune'
+    ' -o -path \'*/migrations/*.py\' -type f -print0'
+    ' | sort -z | xargs -0 sha1sum | sha1sum | cut -c1-40)"; '
+    'echo "applied=$(cat %(marker)s 2>/dev/null)"'
+)
+
+# Lines of the unapplied migrations in the output of showmigrations --plan
+# (Django) and migrate --list (South)
+PENDING_MIGRATION_RE = re.compile(r'^\s*(\[ \]|\( \))\s+(.*)$')
+
+# Applying app.0002_name... OK (0.123s), printed by migrate -v 2
+APPLIED_MIGRATION_RE = re.compile(r'^\s*Applying (\S+)\.\.\. OK(?: \(([\d.]+)s\))?')
 
 @roles('migration')
 @task
-def migrate(option='', syncdb=False):
-    """Run syncdb and migrations. Allowed option: merge"""
+@timed
+def migrate(option='', syncdb=False, force='false'):
+    """Run syncdb and migrations. Allowed option: merge
+
+Skipped if the migration files of the project and of the packages in the
+virtualenv have not changed since the last successful run on the host,
+unless force=true. Otherwise the pending migrations are
+listed before migrating, and the time of each one after.
+    """
     option = "--" + option if option == 'merge' else ''
+    force = bool(strtobool(str(force)))
     activate = os.path.join(env.remote_base, env.virtualenv, 'bin/activate')
     manage = os.path.join(env.remote_base, env.manage)
+    marker = os.path.join(env.remote_base, env.virtualenv, '.migrations-sha1')
+    host = env.host.split('.', 1)[0]
+
+    # The virtualenv is hashed separately, the static root not at all
+    pruned = [env.virtualenv, env.get('static_root')]
+    pruned = [os.path.relpath(os.path.join(env.remote_base, path), env.remote_base) for path in pruned if path]
+    with settings(cd(env.remote_base), hide('stdout', 'running'), warn_only=True):
+        output = run(MIGRATION_STATE % {
+            'virtualenv': quote(os.path.join(env.remote_base, env.virtualenv)),
+            'pruned': ' '.join('-path %s -prune -o' % quote('./' + path)
+                               for path in pruned if not path.startswith('..')),
+            'marker': marker,
+        })
+    state = dict(line.strip().split('=', 1) for line in output.splitlines() if '=' in line)
+    migrations_hash = state.get('migrations')
+    if migrations_hash and migrations_hash == state.get('applied') and not (force or syncdb):
+        print "%s:\t Migrations unchanged since the last migrate, skipping" % host
+        return
+
+    # Django 1.8+ has showmigrations, Django 1.7 and South list the
+    # migrations with migrate --list
+    with settings(hide('stdout', 'running'), warn_only=True):
+        plan = run("source %s; python %s help showmigrations >/dev/null 2>&1"
+                   " && python %s showmigrations --plan || python %s migrate --list" % (
+                       activate, manage, manage, manage))
+    pending = [match.group(2) for match in map(PENDING_MIGRATION_RE.match, plan.splitlines()) if match]
+    if plan.failed:
+        print "%s:\t Could not list the migrations" % host
+        pending = None
+    elif pending:
+        print "%s:\t Pending migrations:" % host
+        for migration in pending:
+            print "\t%s" % migration
+    else:
+        print "%s:\t No pending migrations" % host
+
     if syncdb:
         run("source %s; python %s syncdb" % (activate, manage))
-    run("source %s; python %s migrate %s" % (activate, manage, option))
+    if pending is None or pending or force or syncdb:
+        started = time.time()
+        with settings(hide('stdout'), warn_only=True):
+            output = run("source %s; python %s migrate -v 2 %s" % (activate, manage, option))
+        for match in map(APPLIED_MIGRATION_RE.match, output.splitlines()):
+            if match:
+                print "\t%-60s %ss" % (match.group(1), match.group(2) or '?')
+        if output.failed:
+            print output
+            abort("%s: migrate failed" % host)
+        print "%s:\t Migrated in %.1fs" % (host, time.time() - started)
+
+    if migrations_hash:
+        with hide('stdout', 'running'):
+            run('echo %s > %s' % (migrations_hash, marker))
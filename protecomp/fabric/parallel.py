@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Parallel execution of deploy tasks on multiple hosts
+
+Fabric runs a task on its hosts one after another. Tasks decorated with
+@multihost run on all of their hosts at once, in a bounded pool of worker
+processes, when the parallel mode is on:
+
+    fab production in_parallel:10 status
+
+or with env.parallel_pool_size = 10 in the environment task. The output of
+each host is buffered and printed in one block when the host finishes, and
+the hosts that failed are listed at the end.
+
+run_on_hosts() does the work and takes any callable, so it can be run
+against localhost or with a fake run().
+"""
+from functools import wraps
+from StringIO import StringIO
+import multiprocessing
+import sys
+import time
+import traceback
+
+from fabric.api import abort, env, hide, settings, task
+from fabric.network import disconnect_all, to_dict
+from fabric.state import connections
+
+from . import timing
+
+# The job of the worker processes, set before the pool is forked so that
+# the task does not need to be pickled
+_job = None
+# Results of the hosts not yet visited by Fabric's own host loop, by task
+_pending = {}
+
+
+class HostResult(object):
+    """The return value, error and buffered output of a task on one host"""
+
+    def __init__(self, host, result=None, error=None, output='', duration=0.0, timings=()):
+        self.host = host
+        self.result = result
+        self.error = error
+        self.output = output
+        self.duration = duration
+        # Records of protecomp.fabric.timing made on the worker
+        self.timings = timings
+
+    @property
+    def failed(self):
+        return self.error is not None
+
+
+def _init_worker():
+    # The connections of the parent process must not be shared
+    connections.clear()
+
+
+def _run_job(host):
+    func, args, kwargs = _job
+    buffer = StringIO()
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = sys.stderr = buffer
+    started = time.time()
+    recorded = len(timing.records)
+    result = error = None
+    try:
+        with settings(abort_on_prompts=True, **to_dict(host)):
+            try:
+                result = func(*args, **kwargs)
+            finally:
+                with hide('status'):
+                    disconnect_all()
+    except SystemExit:
+        # abort() has already printed the reason
+        error = 'aborted'
+    except Exception as e:
+        traceback.print_exc()
+        error = '%s: %s' % (e.__class__.__name__, e)
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+    return HostResult(host, result, error, buffer.getvalue(), time.time() - started,
+                      timing.records[recorded:])
+
+
+def run_on_hosts(func, hosts, args=(), kwargs=None, pool_size=10, callback=None):
+    """Run func(*args, **kwargs) on the hosts in at most pool_size processes.
+
+    callback is called with the HostResult of each host as it finishes.
+    Returns the HostResults in the order of hosts.
+    """
+    global _job
+    _job = (func, args, kwargs or {})
+    results = {}
+    pool = multiprocessing.Pool(max(1, min(pool_size, len(hosts))), _init_worker)
+    try:
+        for result in pool.imap_unordered(_run_job, hosts):
+            results[result.host] = result
+            timing.merge(result.timings)
+            if callback:
+                callback(result)
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        _job = None
+    return [results[host] for host in hosts]
+
+
+def print_result(result):
+    print "%s:\t%s in %.1fs" % (result.host, 'FAILED' if result.failed else 'done', result.duration)
+    sys.stdout.write(result.output)
+    sys.stdout.flush()
+
+
+def report(results):
+    """Print the failed hosts, return True if all hosts succeeded"""
+    failed = [result for result in results if result.failed]
+    if not failed:
+        return True
+    print
+    print "Failed on %d of %d hosts:" % (len(failed), len(results))
+    for result in failed:
+        print "\t%s\t%s" % (result.host, result.error)
+    return False
+
+
+def multihost(func):
+    """Run the task on all of its hosts at once in the parallel mode.
+
+    Fabric still calls the task once per host: the first call runs the
+    whole pool and the rest return the results of their hosts.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        pool_size = int(env.get('parallel_pool_size') or 0)
+        hosts = env.get('all_hosts') or []
+        host = env.host_string
+        if _job is not None or pool_size < 1 or len(hosts) < 2 or host not in hosts:
+            return func(*args, **kwargs)
+
+        pending = _pending.get(wrapper)
+        if pending and host in pending:
+            return pending.pop(host)
+
+        results = run_on_hosts(func, hosts, args, kwargs, pool_size, callback=print_result)
+        if not report(results):
+            abort("%s failed on some hosts" % func.__name__)
+        _pending[wrapper] = dict((result.host, result.result) for result in results)
+        return _pending[wrapper].pop(host)
+    return wrapper
+
+
+@task
+def in_parallel(pool_size=10):
+    """Run the following tasks on all of their hosts at once
+
+examples:
+
+    in_parallel status
+    - status from all hosts, 10 hosts at a time
+
+    in_parallel:20 checkout:release
+    """
+    env.parallel_pool_size = int(pool_size)
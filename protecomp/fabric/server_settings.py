@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 from fabric.api import *
 
+import difflib
 import itertools
 ##
 # The main server settings file. Add new servers in the dictionaries below.
@@ -43,8 +44,66 @@ def get_roledefs(hostinfo):
             if host_tags.get(tag, False):
                 roledefs[tag].append(hostname)
 
+    build_index()
     return roledefs
 
+
+class HostIndex(object):
+    """Lookups of roles and processes by host, role and process name, built
+    from env.hostinfo and env.processes. See get_index().
+    """
+
+    def __init__(self, hostinfo, processes):
+        self.key = _index_key(hostinfo, processes)
+        self.host_roles = dict(
+            (hostname, [role for role, value in tags.items() if value])
+            for hostname, tags in hostinfo.iteritems()
+        )
+        self.process_roles = {}
+        for role, d in processes.iteritems():
+            for name in d:
+                self.process_roles.setdefault(name, set()).add(role)
+
+        # Later roles override the process definitions of earlier ones
+        self.host_processes = {}
+        for hostname, roles in self.host_roles.iteritems():
+            roles = set(roles)
+            definitions = {}
+            for role, d in processes.iteritems():
+                if role in roles:
+                    definitions.update(d)
+            self.host_processes[hostname] = definitions
+
+    def unknown_processes(self, process_names):
+        return [name for name in process_names if name not in self.process_roles]
+
+    def suggest(self, name, choices):
+        return difflib.get_close_matches(name, list(choices), n=3)
+
+
+def _index_key(hostinfo, processes):
+    # Changes are noticed when env.hostinfo or env.processes is replaced,
+    # or when hosts, roles or processes are added or removed. Other changes
+    # made in place need an explicit build_index().
+    return (id(hostinfo), len(hostinfo), id(processes), len(processes),
+            sum(len(d) for d in processes.values()))
+
+_index = None
+
+def build_index():
+    """Rebuild the HostIndex, e.g. after changing the roles of a host or a
+    process definition in place in env.hostinfo or env.processes"""
+    global _index
+    _index = HostIndex(env.get('hostinfo', {}), env.get('processes', {}))
+    return _index
+
+def get_index():
+    """Return the HostIndex of the current env, rebuilt if env.hostinfo or
+    env.processes has been replaced or has grown or shrunk"""
+    if _index is None or _index.key != _index_key(env.get('hostinfo', {}), env.get('processes', {})):
+        return build_index()
+    return _index
+
 def single_host(hostname):
     """Returns a role definition with all roles defined to a single host. 
     Usage:
@@ -65,8 +124,7 @@ def single_host(hostname):
 
 
 def get_roles_for_host(hostname):
-    role_dict = env.hostinfo.get(hostname, {})
-    return [key for key, val in role_dict.items() if val]
+    return list(get_index().host_roles.get(hostname, ()))
 
 
 def env_task(*args, **kwargs):
@@ -0,0 +1,71 @@
+"""
+Content-hashed manifests of static files, for deploying only the files
+that changed since the last deployment. Used by the
+deploy.collectstatic_incremental task, the functions work on local
+directories. The manifests are kept outside the static directories, so
+that they are not served.
+"""
+import hashlib
+import json
+import os
+import tarfile
+
+MANIFEST_NAME = '.static-manifest.json'
+
+
+def file_hash(path, chunk_size=65536):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def build_manifest(directory, previous=None):
+    """Return a dict of relative path: [content hash, size, mtime] of the
+    files in directory.
+
+    previous is an earlier result for the same directory, its hashes are
+    reused for the files whose size and modification time have not changed.
+    Manifest files left in the directory by earlier versions are skipped.
+    """
+    previous = previous or {}
+    manifest = {}
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            relpath = os.path.relpath(path, directory)
+            if relpath == MANIFEST_NAME:
+                continue
+            stat = os.stat(path)
+            entry = previous.get(relpath)
+            if entry and entry[1:] == [stat.st_size, int(stat.st_mtime)]:
+                manifest[relpath] = entry
+            else:
+                manifest[relpath] = [file_hash(path), stat.st_size, int(stat.st_mtime)]
+    return manifest
+
+
+def diff_manifests(old, new):
+    """Return the sorted paths changed or added in new, and removed from old"""
+    changed = sorted(path for path, entry in new.iteritems()
+                     if path not in old or old[path][0] != entry[0])
+    removed = sorted(path for path in old if path not in new)
+    return changed, removed
+
+
+def load_manifest(fileobj):
+    try:
+        return json.load(fileobj)
+    except ValueError:
+        return {}
+
+
+def write_archive(directory, paths, fileobj):
+    """Write the paths under directory as a gzipped tar to fileobj, to be
+    extracted over the deployed directory in one go.
+    """
+    with tarfile.open(fileobj=fileobj, mode='w:gz') as archive:
+        for path in paths:
+            archive.add(os.path.join(directory, path), arcname=path, recursive=False)
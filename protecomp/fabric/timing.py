@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Timing of deploy steps
+
+The deploy tasks are decorated with @timed, which records the duration of
+the task on each host. The tasks run on worker processes by
+protecomp.fabric.parallel send their timings back to the fab process. When
+fab exits, the slowest steps are printed and the run is appended to the
+JSON-lines history file env.deploy_history (default '.deploy-history.jsonl'
+in the current directory). The compare_deploy task compares the latest run
+with the median of the earlier ones.
+"""
+from contextlib import contextmanager
+from functools import wraps
+import atexit
+import json
+import os
+import sys
+import time
+
+from fabric.api import env, task
+
+# (step, host, duration, ok) of the steps finished in this process
+records = []
+_started = None
+_pid = None
+
+
+def history_path():
+    return env.get('deploy_history', '.deploy-history.jsonl')
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def _start():
+    global _started, _pid
+    if _pid is None:
+        _pid = os.getpid()
+        _started = time.time()
+        atexit.register(_finish)
+
+
+def merge(timings):
+    """Add the records made on a worker process"""
+    if timings:
+        _start()
+        records.extend(timings)
+
+
+@contextmanager
+def step(name):
+    """Record the duration of the block as the step name on the current host"""
+    _start()
+    started = time.time()
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        records.append((name, env.host or 'local', time.time() - started, ok))
+
+
+def timed(func):
+    """Record the duration of the task on each host"""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with step(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def step_durations(steps):
+    """Return the duration of each step name, the slowest host of a step counts"""
+    durations = {}
+    for entry in steps:
+        durations[entry['step']] = max(durations.get(entry['step'], 0), entry['duration'])
+    return durations
+
+
+def _finish():
+    # Forked worker processes inherit the handler
+    if os.getpid() != _pid or not records:
+        return
+    total = time.time() - _started
+
+    print
+    print "Slowest steps:"
+    for name, host, duration, ok in sorted(records, key=lambda record: -record[2])[:10]:
+        print "\t%-28s %-24s %8.1fs%s" % (name, host, duration, '' if ok else '  FAILED')
+    print "\t%-53s %8.1fs" % ('total', total)
+
+    entry = {
+        'started': _started,
+        'command': ' '.join(sys.argv[1:]),
+        'total': total,
+        'steps': [
+            {'step': name, 'host': host, 'duration': duration, 'ok': ok}
+            for name, host, duration, ok in records
+        ],
+    }
+    try:
+        with open(history_path(), 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+    except IOError as e:
+        print "Could not write the deploy history: %s" % e
+
+
+def load_history(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+@task
+def compare_deploy(factor=1.5, runs=20):
+    """Compare the latest deploy with the median of the earlier runs
+
+Flags the steps and the total that took more than factor times the median
+of the last runs of the same command.
+
+examples:
+
+    compare_deploy
+    compare_deploy:factor=2,runs=50
+    """
+    factor = float(factor)
+    path = history_path()
+    if not os.path.exists(path):
+        print "No deploy history in %s" % path
+        return
+    history = load_history(path)
+    if not history:
+        print "No deploy history in %s" % path
+        return
+    latest = history[-1]
+    earlier = [entry for entry in history[:-1] if entry['command'] == latest['command']][-int(runs):]
+    print "Latest: %s, compared to %d earlier runs" % (latest['command'], len(earlier))
+    if not earlier:
+        return
+
+    latest_durations = step_durations(latest['steps'])
+    latest_durations['total'] = latest['total']
+    earlier_durations = [step_durations(entry['steps']) for entry in earlier]
+    for durations, entry in zip(earlier_durations, earlier):
+        durations['total'] = entry['total']
+
+    slow = 0
+    for name, duration in sorted(latest_durations.items(), key=lambda item: -item[1]):
+        previous = [durations[name] for durations in earlier_durations if name in durations]
+        if not previous:
+            print "\t%-28s %8.1fs  (new)" % (name, duration)
+            continue
+        typical = median(previous)
+        flag = duration > factor * typical
+        slow += flag
+        print "\t%-28s %8.1fs  median %8.1fs%s" % (name, duration, typical, '  SLOW' if flag else '')
+    if slow:
+        print "%d steps slower than %gx the median" % (slow, factor)
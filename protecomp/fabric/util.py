@@ -4,7 +4,7 @@ from other fabfiles
 """
 
 from fabric.api import run, sudo, env, local
-from protecomp.fabric.server_settings import get_roles_for_host
+from protecomp.fabric.server_settings import get_index
 
 import itertools
 
@@ -75,27 +75,25 @@ def get_processes(hostname, process_names=None):
         },
     }
     """
+    index = get_index()
+
     # if process_names param is given, check that they all exist somewhere
     # Otherwise process name is probably misspelled and we should raise an error
-    if process_names and not all([
-        any([(name in d) for d in env.processes.values()])
-        for name in process_names
-    ]):
-        raise Exception(("One of the process names:" if len(process_names) > 1 else "Process name")
+    unknown = index.unknown_processes(process_names or ())
+    if unknown:
+        suggestions = []
+        for name in unknown:
+            matches = index.suggest(name, index.process_roles)
+            if matches:
+                suggestions.append("%s: did you mean %s?" % (name, ', '.join(matches)))
+        raise Exception(("Process names:" if len(unknown) > 1 else "Process name")
                         + " %s not found in any roles, did you misspell it?" %
-                        ','.join(process_names))
-
-    host_roles = get_roles_for_host(hostname)
-
-    # Collect process_definitions to a dict from matching roles
-    process_definitions = {}
-    for role, d in env.processes.iteritems():
-        if role in host_roles:
-            process_definitions.update({k: v for k, v in d.iteritems()})
+                        ','.join(unknown)
+                        + ''.join('\n' + suggestion for suggestion in suggestions))
 
     # Return processes matching one of the process names
     # or all processes if process_names is empty
     return [
-        v for k, v in process_definitions.iteritems()
+        v for k, v in index.host_processes.get(hostname, {}).iteritems()
         if not process_names or k in process_names
     ]
@@ -0,0 +1,138 @@
+"""
+Cache warming after deploys, used by the deploy.warm_cache task.
+
+The URLs are read from a sitemap, a file or the access log, and requested
+from the app servers directly by a few threads at a bounded rate. The page
+cache state of each response is read from the X-Cache-Middleware and
+X-Cache-Update headers set by protecomp.middleware.cache.
+"""
+from collections import Counter
+from Queue import Empty, Queue
+from urlparse import urlsplit, urlunsplit
+import threading
+import time
+import urllib2
+import xml.etree.ElementTree as ElementTree
+
+SITEMAP_NS = '{http://www.sitemaps.org/schemas/sitemap/0.9}'
+USER_AGENT = 'protecomp-warm-cache'
+
+
+def read_url(url, timeout=30):
+    if '://' not in url:
+        with open(url) as f:
+            return f.read()
+    return urllib2.urlopen(urllib2.Request(url, headers={'User-Agent': USER_AGENT}), timeout=timeout).read()
+
+
+def sitemap_urls(location, limit=None):
+    """Returns the page URLs of a sitemap, a file or a URL, following
+    sitemap indexes"""
+    root = ElementTree.fromstring(read_url(location))
+    urls = []
+    if root.tag == SITEMAP_NS + 'sitemapindex':
+        for loc in root.iter(SITEMAP_NS + 'loc'):
+            urls.extend(sitemap_urls(loc.text.strip(), limit and limit - len(urls)))
+            if limit and len(urls) >= limit:
+                break
+    else:
+        urls = [loc.text.strip() for loc in root.iter(SITEMAP_NS + 'loc')]
+    return urls[:limit] if limit else urls
+
+
+def file_urls(path, limit=None):
+    """Returns the URLs or paths of a file, one per line, # starts a comment"""
+    with open(path) as f:
+        urls = [line.split('#', 1)[0].strip() for line in f]
+    urls = [url for url in urls if url]
+    return urls[:limit] if limit else urls
+
+
+# Prints the paths of the successful GET requests in a combined format
+# access log, the most requested first
+ACCESS_LOG_COMMAND = (
+    "awk '$6 == \"\\\"GET\" && $9 == 200 {print $7}' %s"
+    " | sort | uniq -c | sort -rn | head -n %d | awk '{print $2}'"
+)
+
+
+def split_url(url):
+    """Returns the Host header and the path of url, or (None, url) for a path"""
+    parts = urlsplit(url)
+    return parts.netloc or None, urlunsplit(('', '', parts.path or '/', parts.query, ''))
+
+
+class RateLimiter(object):
+    """Spaces the calls of wait() at least 1 / rate seconds apart, across threads"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next = time.time()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.time()
+            delay = self.next - now
+            self.next = max(now, self.next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def fetch(base_url, path, host_header=None, timeout=30):
+    """Requests path from base_url, returns (status, X-Cache-Middleware,
+    X-Cache-Update, duration)"""
+    headers = {'User-Agent': USER_AGENT, 'Accept-Encoding': 'gzip'}
+    if host_header:
+        headers['Host'] = host_header
+    started = time.time()
+    try:
+        response = urllib2.urlopen(urllib2.Request(base_url + path, headers=headers), timeout=timeout)
+        response.read()
+        status = response.getcode()
+        info = response.info()
+    except urllib2.HTTPError as e:
+        status = e.code
+        info = e.info()
+    except Exception as e:
+        return str(e), None, None, time.time() - started
+    return status, info.get('X-Cache-Middleware'), info.get('X-Cache-Update'), time.time() - started
+
+
+def fetch_all(jobs, rate=10, concurrency=4, host_header=None):
+    """Fetches the (base_url, host_header, path) jobs with concurrency threads,
+    at most rate requests per second in total. host_header overrides the
+    Host headers of the jobs. Returns a dict of (base_url, path): fetch()
+    result."""
+    queue = Queue()
+    for job in jobs:
+        queue.put(job)
+    limiter = RateLimiter(rate)
+    results = {}
+
+    def worker():
+        while True:
+            try:
+                base_url, job_host, path = queue.get_nowait()
+            except Empty:
+                return
+            limiter.wait()
+            results[(base_url, path)] = fetch(base_url, path, host_header or job_host)
+
+    threads = [threading.Thread(target=worker) for i in range(max(1, int(concurrency)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def transitions(first, second):
+    """Counts the X-Cache-Middleware states of the two passes, e.g.
+    {('Miss', 'Hit'): 10}"""
+    counts = Counter()
+    for key, result in first.iteritems():
+        after = second.get(key)
+        counts[(result[1] or '-', (after[1] or '-') if after else '-')] += 1
+    return counts
@@ -0,0 +1,106 @@
+from cStringIO import StringIO
+import os
+import shutil
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from protecomp.middleware.profiler import ProfileStore, load_profiles, view_totals
+
+
+class Command(BaseCommand):
+    help = """Reports the view profiles merged by ProfilerMiddleware into
+settings.PROFILER_STORE_DIR.
+
+    profile_stats top [--count N]
+    - lists the views by cumulative time
+
+    profile_stats snapshot <name>
+    - saves the current profiles, e.g. before a deploy
+
+    profile_stats diff <name> [<name>]
+    - compares the average time per request of two snapshots, or of a
+      snapshot and the current profiles
+
+    profile_stats show <view> [--snapshot name] [--count N]
+    - prints the pstats report of a view
+"""
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=('top', 'snapshot', 'diff', 'show'))
+        parser.add_argument('names', nargs='*')
+        parser.add_argument('--count', type=int, default=20)
+        parser.add_argument('--snapshot', default=None)
+        parser.add_argument('--sort', default='cumulative')
+
+    def handle(self, action, names, **options):
+        self.directory = getattr(settings, 'PROFILER_STORE_DIR', None)
+        if not self.directory or not os.path.isdir(self.directory):
+            raise CommandError("settings.PROFILER_STORE_DIR is not set or does not exist")
+        getattr(self, action)(names, **options)
+
+    def snapshot_dir(self, name):
+        if name is None:
+            return self.directory
+        path = os.path.join(self.directory, 'snapshots', name)
+        if not os.path.isdir(path):
+            raise CommandError("Snapshot %s not found" % name)
+        return path
+
+    def top(self, names, count, **options):
+        totals = [(view,) + view_totals(stats) for view, stats in load_profiles(self.directory).items()]
+        totals.sort(key=lambda total: total[2], reverse=True)
+        self.stdout.write("%-50s %10s %12s %10s" % ('view', 'requests', 'total s', 'avg ms'))
+        for view, requests, seconds in totals[:count]:
+            self.stdout.write("%-50s %10d %12.3f %10.1f" % (
+                view, requests, seconds, 1000 * seconds / requests if requests else 0))
+
+    def snapshot(self, names, **options):
+        if len(names) != 1:
+            raise CommandError("Give the snapshot name")
+        path = os.path.join(self.directory, 'snapshots', names[0])
+        if os.path.exists(path):
+            raise CommandError("Snapshot %s already exists" % names[0])
+        os.makedirs(path)
+        for filename in os.listdir(self.directory):
+            if filename.endswith((ProfileStore.SUFFIX, ProfileStore.SUFFIX + ProfileStore.COUNT_SUFFIX)):
+                shutil.copy2(os.path.join(self.directory, filename), path)
+        self.stdout.write("Saved snapshot %s" % names[0])
+
+    def diff(self, names, count, **options):
+        if len(names) not in (1, 2):
+            raise CommandError("Give one or two snapshot names")
+        before = load_profiles(self.snapshot_dir(names[0]))
+        after = load_profiles(self.snapshot_dir(names[1] if len(names) == 2 else None))
+
+        rows = []
+        for view in set(before) | set(after):
+            averages = []
+            for profiles in (before, after):
+                requests, seconds = view_totals(profiles[view]) if view in profiles else (0, 0.0)
+                averages.append(1000 * seconds / requests if requests else None)
+            change = averages[1] - averages[0] if None not in averages else None
+            rows.append((view, averages[0], averages[1], change))
+        rows.sort(key=lambda row: abs(row[3]) if row[3] is not None else -1, reverse=True)
+
+        def ms(value):
+            return '%.1f' % value if value is not None else '-'
+
+        self.stdout.write("%-50s %10s %10s %10s %8s" % ('view', 'before ms', 'after ms', 'change', '%'))
+        for view, old, new, change in rows[:count]:
+            if change is None:
+                change, percent = '-', ''
+            else:
+                change, percent = '%+.1f' % change, '%+.0f%%' % (100 * change / old) if old else ''
+            self.stdout.write("%-50s %10s %10s %10s %8s" % (view, ms(old), ms(new), change, percent))
+
+    def show(self, names, count, snapshot, sort, **options):
+        if len(names) != 1:
+            raise CommandError("Give the view name")
+        profiles = load_profiles(self.snapshot_dir(snapshot))
+        if names[0] not in profiles:
+            raise CommandError("No profile for view %s" % names[0])
+        stats = profiles[names[0]]
+        stats.stream = StringIO()
+        stats.sort_stats(sort).print_stats(count)
+        self.stdout.write(stats.stream.getvalue(), ending='')
@@ -0,0 +1,7 @@
+try:
+    from django.utils.deprecation import MiddlewareMixin
+except ImportError:
+    class MiddlewareMixin(object):
+        """Django < 1.10 calls the process_* methods only"""
+        def __init__(self, get_response=None):
+            self.get_response = get_response
@@ -1,26 +1,714 @@
 from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponseNotModified
+from django.template.loader import render_to_string
+from django.db.models import Model, QuerySet
+from django.db.models.signals import post_delete, post_save
 from django.middleware.cache import UpdateCacheMiddleware, FetchFromCacheMiddleware
-from django.utils.safestring import mark_safe
+from django.utils.cache import (
+    _i18n_cache_key_suffix, cc_delim_re,
+    get_max_age, has_vary_header, patch_response_headers, patch_vary_headers,
+)
+from django.utils.crypto import constant_time_compare, salted_hmac
+from django.utils.encoding import force_bytes, iri_to_uri
+from django.utils.module_loading import import_string
+from django.utils.text import compress_string
+from django.utils.translation import trans_real
 
+from protecomp.middleware import MiddlewareMixin, timing
+
+from collections import OrderedDict
+import copy
+import hashlib
+import math
 import re
+import threading
+import time
+import uuid
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 _HTML_TYPES = ('text/html', 'application/xhtml+xml')
 
+CSRFTOKEN_RE = re.compile(r'csrfmiddlewaretoken[^>]*value=(?:\'|")([a-z0-9]+)(?:\'|")', re.IGNORECASE)
+
+CSRF_SLOT = 'csrf_token'
+
+# Slots of fragments are named (FRAGMENT_SLOT, template name, timeout)
+FRAGMENT_SLOT = 'fragment'
+FRAGMENT_START = '<!--protecomp:fragment '
+# The markers are signed, and a fragment can't contain the start of another
+# one, so that markers in user content can't punch the page
+FRAGMENT_RE = re.compile(
+    r'<!--protecomp:fragment (\S+) (\d+) ([0-9a-f]+)-->((?:(?!%s).)*?)<!--/protecomp:fragment \3-->'
+    % re.escape(FRAGMENT_START), re.DOTALL)
+# The markers never leave the process that rendered them
+FRAGMENT_SECRET = uuid.uuid4().hex
+
+
+def _gunzip(data):
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+# Content-Encoding: (compress, decompress)
+COMPRESSORS = {
+    'gzip': (compress_string, _gunzip),
+}
+if brotli is not None:
+    COMPRESSORS['br'] = (brotli.compress, brotli.decompress)
+if zstandard is not None:
+    COMPRESSORS['zstd'] = (
+        lambda data: zstandard.ZstdCompressor().compress(data),
+        lambda data: zstandard.ZstdDecompressor().decompress(data),
+    )
+
+
+def parse_accept_encoding(value):
+    """Returns the sets of content codings accepted and refused (q=0) by an
+    Accept-Encoding value"""
+    accepted = set()
+    refused = set()
+    for coding in value.lower().split(','):
+        coding, _, params = coding.partition(';')
+        params = params.replace(' ', '')
+        if params.startswith('q=') and not params[2:].strip('0.'):
+            refused.add(coding.strip())
+        else:
+            accepted.add(coding.strip())
+    return accepted, refused
+
+
+def encoding_accepted(accepted, refused, encoding):
+    """Whether encoding is acceptable, * only stands for the codings not
+    listed in the header"""
+    return encoding in accepted or ('*' in accepted and encoding not in refused)
+
+
+def accepts_encoding(request, encoding):
+    accepted, refused = parse_accept_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+    return encoding_accepted(accepted, refused, encoding)
+
+
+def copy_response(response):
+    """Returns a shallow copy of response with its own headers and cookies"""
+    clone = response.__class__.__new__(response.__class__)
+    clone.__dict__.update(response.__dict__)
+    clone._headers = response._headers.copy()
+    if response.cookies:
+        clone.cookies = copy.deepcopy(response.cookies)
+    else:
+        clone.cookies = response.cookies.__class__()
+    clone._closable_objects = []
+    return clone
+
+
+class LocalPageCache(object):
+    '''
+    Per-process LRU of cached pages, used by CustomFetchFromCacheMiddleware in
+    front of the shared cache. The total size of the entries is limited to
+    max_bytes. An entry is served for timeout seconds, after that its
+    version is compared with the version in the shared cache before it is
+    used again.
+
+    Entries are returned as is, callers must copy them before modifying.
+    Entries stored without a version are only used for timeout seconds.
+    '''
+
+    def __init__(self, max_bytes, timeout):
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.size = 0
+        self._entries = OrderedDict()  # key: [value, version, size, checked]
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns (value, version, fresh) or None"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            self._entries[key] = entry
+        return entry[0], entry[1], time.time() - entry[3] < self.timeout
+
+    def touch(self, key):
+        """Marks the entry checked against the shared cache"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry[3] = time.time()
+
+    def set(self, key, value, version, size):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._delete(key)
+            self._entries[key] = [value, version, size, time.time()]
+            self.size += size
+            while self.size > self.max_bytes:
+                self._delete(next(iter(self._entries)))
+
+    def delete(self, key):
+        with self._lock:
+            self._delete(key)
+
+    def _delete(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+
+def response_size(response):
+    return len(response.content) + sum(len(k) + len(v) for k, v in response._headers.values())
+
+
+def is_html(response):
+    return response.get('Content-Type', '').split(';')[0] in _HTML_TYPES
+
+
+def find_csrf_slots(content):
+    """
+    Returns a list of (start, end, CSRF_SLOT) tuples, one for each occurrence
+    of the CSRF token used in content.
+    """
+    match = CSRFTOKEN_RE.search(content)
+    if not match:
+        return []
+    token = match.group(1)
+    slots = []
+    start = content.find(token)
+    while start != -1:
+        end = start + len(token)
+        slots.append((start, end, CSRF_SLOT))
+        start = content.find(token, end)
+    return slots
+
+
+def splice_content(content, slots, values):
+    """
+    Replaces the (start, end, name) slots of content with values[name] and
+    returns the new content and the slots moved to their new offsets.
+    Slots must be sorted and non-overlapping. The content is not rescanned,
+    the result is built with a single join.
+    """
+    chunks = []
+    new_slots = []
+    position = 0
+    shift = 0
+    for start, end, name in slots:
+        value = values.get(name)
+        if value is None:
+            value = content[start:end]
+        chunks.append(content[position:start])
+        chunks.append(value)
+        new_start = start + shift
+        new_slots.append((new_start, new_start + len(value), name))
+        shift += len(value) - (end - start)
+        position = end
+    chunks.append(content[position:])
+    return ''.join(chunks), new_slots
+
+
+def sort_slots(slots):
+    return sorted(slots, key=lambda slot: slot[0])
+
+
+def is_fragment_slot(name):
+    return isinstance(name, tuple) and name[0] == FRAGMENT_SLOT
+
+
+def fragment_signature(template_name, timeout):
+    return salted_hmac('protecomp.fragment', '%s %d' % (template_name, timeout),
+                       secret=FRAGMENT_SECRET).hexdigest()
+
+
+def fragment_marker(template_name, timeout, content):
+    """Wraps the rendered fragment in the markers found by punch_fragments"""
+    timeout = int(timeout or 0)
+    signature = fragment_signature(template_name, timeout)
+    return '<!--protecomp:fragment %s %d %s-->%s<!--/protecomp:fragment %s-->' % (
+        template_name, timeout, signature, content, signature)
+
+
+def render_fragment(request, template_name):
+    """Renders a fragment template, with the context processors only"""
+    return render_to_string(template_name, request=request)
+
+
+def punch_fragments(content):
+    """
+    Returns the content without the fragment markers, the content with the
+    fragments removed and the (start, end, name) slots of the removed
+    fragments in the latter. Markers not made by fragment_marker in this
+    process are left alone.
+    """
+    live = []
+    punched = []
+    slots = []
+    position = 0
+    offset = 0
+    for match in FRAGMENT_RE.finditer(content):
+        template_name, timeout = match.group(1), int(match.group(2))
+        if not constant_time_compare(match.group(3), fragment_signature(template_name, timeout)):
+            continue
+        before = content[position:match.start()]
+        live.append(before)
+        live.append(match.group(4))
+        punched.append(before)
+        offset += len(before)
+        slots.append((offset, offset, (FRAGMENT_SLOT, template_name, timeout)))
+        position = match.end()
+    live.append(content[position:])
+    punched.append(content[position:])
+    return ''.join(live), ''.join(punched), slots
+
+
+def fragment_key(request, template_name, key_prefix=''):
+    """
+    Returns the cache key of a fragment for the user of request, or None if
+    the request has neither a user nor a session.
+    """
+    user_id = getattr(getattr(request, 'user', None), 'pk', None)
+    if user_id is not None:
+        ident = 'user.%s' % user_id
+    else:
+        ident = getattr(getattr(request, 'session', None), 'session_key', None)
+        if ident is None:
+            return None
+        ident = 'session.%s' % ident
+    key = 'protecomp.cache.fragment.%s.%s.%s' % (
+        key_prefix,
+        hashlib.md5(force_bytes(template_name)).hexdigest(),
+        hashlib.md5(force_bytes(ident)).hexdigest(),
+    )
+    return _i18n_cache_key_suffix(request, key)
+
+
+def fill_fragments(request, response, cache, key_prefix=''):
+    """
+    Renders the fragments of a cached page for request and splices them into
+    the page. Fragments with a timeout are cached per user for that long.
+    The fragment slots are replaced with the slots of the CSRF tokens
+    rendered into the fragments.
+    """
+    slots = response._cache_slots
+    names = set(name for start, end, name in slots if is_fragment_slot(name))
+    keys = {}
+    for name in names:
+        if name[2]:
+            key = fragment_key(request, name[1], key_prefix)
+            if key is not None:
+                keys[name] = key
+    cached = cache.get_many(list(keys.values())) if keys else {}
+
+    values = {}
+    for name in names:
+        value = cached.get(keys.get(name))
+        if value is None:
+            value = force_bytes(render_fragment(request, name[1]), response.charset)
+            if name in keys:
+                cache.set(keys[name], value, name[2])
+        values[name] = value
+
+    content, slots = splice_content(response.content, slots, values)
+    new_slots = []
+    for start, end, name in slots:
+        if is_fragment_slot(name):
+            new_slots.extend((start + token_start, start + token_end, slot_name)
+                             for token_start, token_end, slot_name in find_csrf_slots(content[start:end]))
+        else:
+            new_slots.append((start, end, name))
+    response.content = content
+    response._cache_slots = sort_slots(new_slots)
+    if response.has_header('Content-Length'):
+        response['Content-Length'] = str(len(content))
+    # The ETag of the stored page is not valid for the filled one
+    if response.has_header('ETag'):
+        del response['ETag']
+    patch_vary_headers(response, ('Cookie',))
+
+
+# Headers of a cached page repeated in its 304 responses
+NOT_MODIFIED_HEADERS = ('Cache-Control', 'Content-Location', 'Expires', 'Last-Modified', 'Vary')
+
+
+def page_etag(content, slots):
+    """
+    Returns a hash of content with the CSRF token slots left out, so that it
+    does not change when the tokens are rewritten. Returns None for pages
+    with fragments, they differ per user.
+    """
+    digest = hashlib.md5()
+    position = 0
+    for start, end, name in slots or ():
+        if is_fragment_slot(name):
+            return None
+        digest.update(content[position:start])
+        position = end
+    digest.update(content[position:])
+    return digest.hexdigest()
+
+
+def page_meta(response, etag, soft_expires):
+    """The metadata stored next to a cached page, enough to answer a
+    conditional request for the page without loading it"""
+    return {
+        'etag': etag,
+        'csrf': any(name == CSRF_SLOT for start, end, name in getattr(response, '_cache_slots', None) or ()),
+        'soft_expires': soft_expires,
+        'headers': [(header, response[header]) for header in NOT_MODIFIED_HEADERS if response.has_header(header)],
+    }
+
+
+def served_etag(request, meta):
+    """
+    Returns the weak ETag of a cached page for request. Pages with CSRF
+    tokens get a hash of the CSRF cookie appended, so that a client keeps
+    its copy only while the token in it is valid.
+    """
+    if meta['csrf']:
+        csrf_token = request.META.get('CSRF_COOKIE') or ''
+        return 'W/"%s-%s"' % (meta['etag'], hashlib.md5(force_bytes(csrf_token)).hexdigest()[:8])
+    return 'W/"%s"' % meta['etag']
+
+
+def etag_matches(if_none_match, etag):
+    """Weak comparison of an If-None-Match value with etag"""
+    if if_none_match.strip() == '*':
+        return True
+    if etag.startswith('W/'):
+        etag = etag[2:]
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+class CookieNormalizer(object):
+    '''
+    Reduces a Cookie header to the cookies that can affect the page content,
+    so that e.g. analytics cookies do not split the cache key.
+
+    Cookies are filtered by name with either an allowlist or a denylist. A
+    denylist entry ending with '*' matches by name prefix. The header is
+    tokenized in a single pass, the kept cookies are sorted by name and the
+    results are memoized per header value.
+    '''
+
+    MEMO_SIZE = 1024
+
+    def __init__(self, allow=None, deny=(), memo_size=MEMO_SIZE):
+        self.allow = frozenset(allow) if allow is not None else None
+        self.deny = frozenset(name for name in deny if not name.endswith('*'))
+        self.deny_prefixes = tuple(name[:-1] for name in deny if name.endswith('*'))
+        self.memo_size = memo_size
+        self._memo = {}
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            allow=getattr(settings, 'CACHE_MIDDLEWARE_COOKIE_ALLOWLIST', None),
+            deny=getattr(settings, 'CACHE_MIDDLEWARE_COOKIE_DENYLIST', ('_*', 'ki*', '2c*')),
+        )
+
+    def keep(self, name):
+        if self.allow is not None:
+            return name in self.allow
+        return not (name in self.deny or name.startswith(self.deny_prefixes))
+
+    def normalize(self, header):
+        if not header:
+            return header
+        try:
+            return self._memo[header]
+        except KeyError:
+            pass
+
+        cookies = []
+        for token in header.split(';'):
+            name, _, value = token.partition('=')
+            name = name.strip()
+            if name and self.keep(name):
+                cookies.append((name, value.strip()))
+        # Stable sort, so the order of duplicate names is preserved
+        cookies.sort(key=lambda cookie: cookie[0])
+        normalized = '; '.join(['%s=%s' % cookie for cookie in cookies])
+
+        if len(self._memo) >= self.memo_size:
+            self._memo.clear()
+        self._memo[header] = normalized
+        return normalized
+
+
+class CacheKeyBuilder(object):
+    '''
+    Builds the page cache keys for CustomUpdateCacheMiddleware and
+    CustomFetchFromCacheMiddleware. Works like Django's learn_cache_key and
+    get_cache_key, but the value of each header named in Vary is reduced to a
+    canonical value before hashing. This way e.g. Accept-Encoding variants
+    do not split one page across several cache entries.
+
+    A header is canonicalized by the method canonical_<meta name>, e.g.
+    canonical_http_accept_encoding. Headers without a method are hashed as
+    is. Use settings.CACHE_MIDDLEWARE_KEY_BUILDER to plug in a subclass.
+    '''
+
+    def __init__(self):
+        self.encodings = getattr(settings, 'CACHE_MIDDLEWARE_ENCODINGS', ('gzip',))
+
+    def canonical_value(self, request, header):
+        value = request.META.get(header)
+        if value is None:
+            return None
+        canonicalize = getattr(self, 'canonical_' + header.lower(), None)
+        if canonicalize is None:
+            return value
+        return canonicalize(value)
+
+    def canonical_http_accept_encoding(self, value):
+        """Returns the first of settings.CACHE_MIDDLEWARE_ENCODINGS accepted"""
+        accepted, refused = parse_accept_encoding(value)
+        for encoding in self.encodings:
+            if encoding_accepted(accepted, refused, encoding):
+                return encoding
+        return 'identity'
+
+    def canonical_http_accept_language(self, value):
+        """Returns the preferred language of settings.LANGUAGES"""
+        for lang, _ in trans_real.parse_accept_lang_header(value):
+            if lang == '*':
+                break
+            try:
+                return trans_real.get_supported_language_variant(lang)
+            except LookupError:
+                continue
+        return settings.LANGUAGE_CODE
+
+    def page_key(self, request, method, headerlist, key_prefix):
+        ctx = hashlib.md5()
+        for header in headerlist:
+            value = self.canonical_value(request, header)
+            if value is not None:
+                ctx.update(force_bytes('%s:%s;' % (header, value)))
+        cache_key = 'protecomp.cache.page.%s.%s.%s.%s' % (
+            key_prefix, method, self.url_hash(request), ctx.hexdigest())
+        return _i18n_cache_key_suffix(request, cache_key)
+
+    def url_hash(self, request):
+        """Returns the hash of the absolute URL, computed once per request"""
+        try:
+            return request._cache_url_hash
+        except AttributeError:
+            url = force_bytes(iri_to_uri(request.build_absolute_uri()))
+            request._cache_url_hash = hashlib.md5(url).hexdigest()
+            return request._cache_url_hash
+
+    def learn(self, request, response, timeout, key_prefix, cache):
+        """Stores the headers named in Vary and returns the page key. Cookie
+        is left out for responses marked with share_response."""
+        headerlist = []
+        if response.has_header('Vary'):
+            # With i18n the key already contains the active language
+            skip_language = settings.USE_I18N or settings.USE_L10N
+            for header in cc_delim_re.split(response['Vary']):
+                header = 'HTTP_' + header.upper().replace('-', '_')
+                if header == 'HTTP_ACCEPT_LANGUAGE' and skip_language:
+                    continue
+                if header == 'HTTP_COOKIE' and getattr(response, '_cache_shared', False):
+                    continue
+                headerlist.append(header)
+            headerlist.sort()
+        cache.set(self.header_key(request, key_prefix), headerlist, timeout)
+        return self.page_key(request, request.method, headerlist, key_prefix)
+
+    def header_key(self, request, key_prefix):
+        """Returns the key of the header list, same as Django's"""
+        cache_key = 'views.decorators.cache.cache_header.%s.%s' % (key_prefix, self.url_hash(request))
+        return _i18n_cache_key_suffix(request, cache_key)
+
+    def get(self, request, key_prefix, method, cache):
+        """Returns the page key, or None if the headers are not known yet"""
+        headerlist = cache.get(self.header_key(request, key_prefix))
+        if headerlist is None:
+            return None
+        return self.page_key(request, method, headerlist, key_prefix)
+
+
+def cache_tag(obj):
+    """
+    Returns the cache tag of obj: a model instance is tagged by its primary
+    key, a model class or a queryset by its model. Strings are used as is.
+    """
+    if isinstance(obj, basestring):
+        return obj
+    if isinstance(obj, QuerySet):
+        obj = obj.model
+    if isinstance(obj, Model):
+        return '%s.%s:%s' % (obj._meta.app_label, obj._meta.model_name, obj.pk)
+    if isinstance(obj, type) and issubclass(obj, Model):
+        return '%s.%s' % (obj._meta.app_label, obj._meta.model_name)
+    raise TypeError("Can't create a cache tag for %r" % obj)
+
+
+def tag_index_key(tag):
+    return 'protecomp.cache.tag.%s' % hashlib.md5(force_bytes(tag)).hexdigest()
+
+
+def tag_response(response, *objects):
+    """
+    Tags a response written to cache by CustomUpdateCacheMiddleware, so it can
+    be deleted with invalidate_tags. Objects are passed to cache_tag.
+
+    Usage in a view:
+
+        response = render(request, 'article.html', {'article': article})
+        return tag_response(response, article, Comment.objects.all())
+    """
+    tags = getattr(response, '_cache_tags', None)
+    if tags is None:
+        tags = response._cache_tags = set()
+    tags.update(cache_tag(obj) for obj in objects)
+    return response
+
+
+def share_response(response):
+    """
+    Marks a response as the same for all users outside its fragments, so
+    that CustomUpdateCacheMiddleware leaves Cookie out of its page key and
+    caches it once for all sessions. The template must not render anything
+    user specific outside the fragment tags, e.g. {{ user.username }}: it
+    would be served to everyone.
+
+        return share_response(render(request, 'article.html', context))
+    """
+    response._cache_shared = True
+    return response
+
+
+def invalidate_tags(*objects, **kwargs):
+    """
+    Deletes the pages tagged with any of objects from cache, in batches of
+    batch_size keys. Returns the number of keys deleted.
+
+    Keyword arguments:
+    cache       the cache to use, default settings.CACHE_MIDDLEWARE_ALIAS
+    batch_size  keys per delete_many call, default 500
+    """
+    cache = kwargs.get('cache') or caches[settings.CACHE_MIDDLEWARE_ALIAS]
+    batch_size = kwargs.get('batch_size', 500)
+
+    index_keys = [tag_index_key(cache_tag(obj)) for obj in objects]
+    now = time.time()
+    keys = set()
+    for index in cache.get_many(index_keys).values():
+        keys.update(key for key, expires in index.items() if expires > now)
+    keys = sorted(keys)
+    # The versions and metadata first, so that they never outlive a page
+    metadata = [key + suffix for key in keys for suffix in ('.version', '.meta')]
+    for i in range(0, len(metadata), batch_size):
+        cache.delete_many(metadata[i:i + batch_size])
+    for i in range(0, len(keys), batch_size):
+        cache.delete_many(keys[i:i + batch_size])
+    cache.delete_many(index_keys)
+    return len(keys)
+
+
+def _invalidate_instance(sender, instance, **kwargs):
+    invalidate_tags(instance, sender)
+
+
+def invalidate_on_save(*models):
+    """
+    Invalidates the pages tagged with an instance or its model when the
+    instance is saved or deleted. Call e.g. in AppConfig.ready:
+
+        invalidate_on_save(Article, Comment)
+    """
+    for model in models:
+        for signal in (post_save, post_delete):
+            signal.connect(_invalidate_instance, sender=model, weak=False,
+                           dispatch_uid='protecomp.cache.invalidate.%s' % cache_tag(model))
+
+
+def get_key_builder():
+    path = getattr(settings, 'CACHE_MIDDLEWARE_KEY_BUILDER',
+                   'protecomp.middleware.cache.CacheKeyBuilder')
+    return import_string(path)()
+
+
 class CustomUpdateCacheMiddleware(UpdateCacheMiddleware):
     '''
     Parses certain (mostly analytics scripts related) cookies from
     request in order to solve cache issues. Due to the cookies
     the cache key for unchanged content differed so no cache hits were
     commited.
+
+    The cookies are filtered by CookieNormalizer, configured with
+    settings.CACHE_MIDDLEWARE_COOKIE_ALLOWLIST or
+    settings.CACHE_MIDDLEWARE_COOKIE_DENYLIST. Note that the stripped cookies
+    are not visible to the views either, so an allowlist must contain
+    e.g. the session cookie.
+
+    Cache keys are built with the CacheKeyBuilder, see get_key_builder.
+
+    If settings.CACHE_MIDDLEWARE_STALE_SECONDS is set, pages are kept in the
+    cache that much longer than their timeout (the hard TTL), and
+    CustomFetchFromCacheMiddleware serves them stale while one request
+    revalidates the page.
+
+    Pages tagged with tag_response are added to a tag -> cache key index, see
+    invalidate_tags. The index is updated with get/set, so concurrent writes
+    to the same tag may drop a key from it. An index is kept as long as the
+    longest-lived of its pages.
+
+    settings.CACHE_MIDDLEWARE_COMPRESS lists the encodings to store pages
+    in, e.g. ('br', 'gzip'). The first one available is used, brotli and
+    zstd need the brotli and zstandard packages. Pages with CSRF tokens are
+    rewritten per user and are stored uncompressed, as are pages already
+    encoded by an inner middleware.
+
+    If settings.CACHE_MIDDLEWARE_L1_BYTES is set, a version is stored with
+    each page for the per-process cache of CustomFetchFromCacheMiddleware.
+
+    Pages without fragments get a weak ETag computed with the CSRF tokens
+    left out, see served_etag. It is stored with the page's 304 headers in
+    a metadata entry next to the page.
+
+    Regions of a page rendered with the fragment template tag
+    ({% load fragments %}{% fragment "login_box.html" 60 %}) are left out
+    of the cached page, and rendered for each request on a cache hit by
+    CustomFetchFromCacheMiddleware. The fragment templates get the context
+    of the context processors only. With a timeout, the rendered fragments
+    are cached for that many seconds per user (or session). Responses with
+    fragments vary on Cookie, so the page is cached per user unless the view
+    marks it with share_response.
     '''
 
-    STRIP_RE = re.compile(r'\b((_|ki|2c)[^=]+=.+?(?:; |$))')
-    STRIP_CSRF_RE = re.compile(r'csrftoken=[ a-z0-9]*(; |$)')
+    def __init__(self, *args, **kwargs):
+        super(CustomUpdateCacheMiddleware, self).__init__(*args, **kwargs)
+        self.cookie_normalizer = CookieNormalizer.from_settings()
+        self.key_builder = get_key_builder()
+        self.stale_seconds = getattr(settings, 'CACHE_MIDDLEWARE_STALE_SECONDS', 0)
+        self.encoding = next((encoding for encoding in getattr(settings, 'CACHE_MIDDLEWARE_COMPRESS', ())
+                              if encoding in COMPRESSORS), None)
+        self.versioned = bool(getattr(settings, 'CACHE_MIDDLEWARE_L1_BYTES', 0))
 
-    def process_request(self, request):               
-        cookie = self.STRIP_RE.sub('', request.META.get('HTTP_COOKIE', ''))   
-#        cookie = self.STRIP_CSRF_RE.sub('', cookie)
-        request.META['HTTP_COOKIE'] = cookie                      
+    def process_request(self, request):
+        started = timing.start()
+        cookie = request.META.get('HTTP_COOKIE')
+        if cookie:
+            request.META['HTTP_COOKIE'] = self.cookie_normalizer.normalize(cookie)
+        timing.record(request, 'cookies', started)
 
     def _should_update_cache(self, request, response):
         should = super(CustomUpdateCacheMiddleware, self)._should_update_cache(request, response)
@@ -30,59 +718,411 @@ class CustomUpdateCacheMiddleware(UpdateCacheMiddleware):
             response['X-Cache-Update'] = 'False'
         return should
 
+    def process_response(self, request, response):
+        """Sets the cache, if needed."""
+        started = timing.start()
+        try:
+            self._punch_fragments(response)
+            return self._update_cache(request, response)
+        finally:
+            timing.record(request, 'cache-update', started)
+
+    def _punch_fragments(self, response):
+        """Removes the fragment markers from the response, and keeps the
+        content without the fragments for the cache"""
+        if (getattr(response, 'streaming', False) or not getattr(response, 'is_rendered', True)
+                or not is_html(response) or FRAGMENT_START not in response.content):
+            return
+        response.content, punched, slots = punch_fragments(response.content)
+        if slots:
+            response._cache_fragments = (punched, slots)
+            # The fragments are per user
+            patch_vary_headers(response, ('Cookie',))
+        if response.has_header('Content-Length'):
+            response['Content-Length'] = str(len(response.content))
+
+    def _update_cache(self, request, response):
+        if not self._should_update_cache(request, response):
+            return response
+
+        if getattr(response, 'streaming', False) or response.status_code not in (200, 304):
+            return response
+
+        # Don't cache responses that set a user-specific (and maybe security
+        # sensitive) cookie in response to a cookie-less request.
+        if not request.COOKIES and response.cookies and has_vary_header(response, 'Cookie'):
+            return response
+
+        timeout = get_max_age(response)
+        if timeout is None:
+            timeout = self.cache_timeout
+        elif timeout == 0:
+            return response
+        patch_response_headers(response, timeout)
+        if timeout and response.status_code == 200:
+            cache_key = self.key_builder.learn(request, response, timeout + self.stale_seconds,
+                                               self.key_prefix, self.cache)
+            if hasattr(response, 'render') and callable(response.render):
+                response.add_post_render_callback(
+                    lambda r: self._store(request, r, cache_key, timeout)
+                )
+            else:
+                self._store(request, response, cache_key, timeout)
+        return response
+
+    def _store(self, request, response, cache_key, timeout):
+        fragments = getattr(response, '_cache_fragments', None)
+        if fragments is not None:
+            # Store the page without the fragments of this user
+            punched, fragment_slots = fragments
+            response = copy_response(response)
+            del response._cache_fragments
+            response.content = punched
+            response._cache_slots = sort_slots(find_csrf_slots(punched) + fragment_slots)
+        elif is_html(response) and getattr(response, '_cache_slots', None) is None:
+            # Record the token offsets for CsrfTokenUpdaterMiddleware
+            response._cache_slots = find_csrf_slots(response.content)
+        if self.stale_seconds:
+            response._cache_soft_expires = time.time() + timeout
+        etag = page_etag(response.content, getattr(response, '_cache_slots', None))
+        if etag is not None:
+            response._cache_meta = page_meta(response, etag, getattr(response, '_cache_soft_expires', None))
+            # The ETag the page is served with from cache
+            response['ETag'] = served_etag(request, response._cache_meta)
+        stored = self._compress(response)
+
+        entries = {cache_key: stored}
+        if self.versioned:
+            stored._cache_version = uuid.uuid4().hex
+            entries[cache_key + '.version'] = stored._cache_version
+        if etag is not None:
+            entries[cache_key + '.meta'] = response._cache_meta
+        if len(entries) > 1:
+            self.cache.set_many(entries, timeout + self.stale_seconds)
+        else:
+            self.cache.set(cache_key, stored, timeout + self.stale_seconds)
+
+        tags = getattr(response, '_cache_tags', None)
+        if tags:
+            self._index_tags(tags, cache_key, timeout + self.stale_seconds)
+
+        lock_key = getattr(request, '_cache_lock_key', None)
+        if lock_key is not None:
+            self.cache.delete(lock_key)
+
+    def _compress(self, response):
+        """Returns a copy of response with the content compressed, if possible"""
+        if (self.encoding is None or response.has_header('Content-Encoding')
+                or getattr(response, '_cache_slots', None) or len(response.content) < 200):
+            return response
+        compressed = COMPRESSORS[self.encoding][0](response.content)
+        if len(compressed) >= len(response.content):
+            return response
+        stored = copy_response(response)
+        stored.content = compressed
+        stored._cache_encoding = self.encoding
+        return stored
+
+    def _index_tags(self, tags, cache_key, timeout):
+        """Adds cache_key to the indexes of tags. An index maps the cache
+        keys to their expiry times and is kept until its last key expires,
+        the expired keys are pruned here."""
+        now = time.time()
+        index_keys = [tag_index_key(tag) for tag in tags]
+        indexes = self.cache.get_many(index_keys)
+        for index_key in index_keys:
+            index = dict((key, expires) for key, expires in indexes.get(index_key, {}).items()
+                         if expires > now)
+            index[cache_key] = now + timeout
+            indexes[index_key] = index
+        longest = max(max(index.values()) for index in indexes.values())
+        self.cache.set_many(indexes, int(math.ceil(longest - now)))
+
 class CustomFetchFromCacheMiddleware(FetchFromCacheMiddleware):
     '''
     Adds informative headers about caching to the response
+
+    X-Cache-Middleware is one of:
+
+    - Hit: served from cache
+    - Miss: not in cache, rendered by the view
+    - Stale: past its soft TTL, served from cache while another request
+      revalidates it
+    - Revalidating: past its soft TTL, rendered by the view to update the
+      cache
+    - Not-Modified: answered with 304, the ETag in If-None-Match matches
+      the metadata of the cached page
+
+    Only one request at a time revalidates a page. It holds a lock, added to
+    the cache with a timeout of settings.CACHE_MIDDLEWARE_LOCK_SECONDS and
+    deleted once the page is updated. If the view fails, stale content is
+    served until the lock expires.
+
+    Pages stored compressed are served as is to clients accepting the
+    encoding, and decompressed for the others.
+
+    The fragments left out of a cached page are rendered for the request
+    and spliced in, see fill_fragments.
+
+    If settings.CACHE_MIDDLEWARE_L1_BYTES is set, pages are also kept in a
+    per-process LocalPageCache of that size. Its entries are checked against
+    the page version in the shared cache every
+    settings.CACHE_MIDDLEWARE_L1_SECONDS (default 5), so invalidated pages
+    may be served from it for that long. Hits are then reported as Hit-L1 or
+    Hit-L2, depending on the cache that answered.
     '''
+
+    def __init__(self, *args, **kwargs):
+        super(CustomFetchFromCacheMiddleware, self).__init__(*args, **kwargs)
+        self.key_builder = get_key_builder()
+        self.lock_seconds = getattr(settings, 'CACHE_MIDDLEWARE_LOCK_SECONDS', 30)
+        l1_bytes = getattr(settings, 'CACHE_MIDDLEWARE_L1_BYTES', 0)
+        if l1_bytes:
+            self.local_cache = LocalPageCache(l1_bytes, getattr(settings, 'CACHE_MIDDLEWARE_L1_SECONDS', 5))
+        else:
+            self.local_cache = None
+
     def process_request(self, request):
         """
         Checks whether the page is already cached and returns the cached
         version if available.
         """
-        response = super(CustomFetchFromCacheMiddleware, self).process_request(request)
-        if response:
-            response['X-Cache-Middleware'] = 'Hit'
+        started = timing.start()
+        try:
+            return self._fetch(request)
+        finally:
+            timing.record(request, 'cache-fetch', started)
+
+    def _fetch(self, request):
+        if request.method not in ('GET', 'HEAD'):
+            request._cache_update_cache = False
+            return None
+
+        cache_key = self._page_key(request, 'GET')
+        if cache_key is None:
+            request._cache_update_cache = True
+            return None
+
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match and request.method == 'GET':
+            response = self._not_modified(request, cache_key, if_none_match)
+            if response is not None:
+                return response
+
+        response, state = self._get(cache_key)
+        if response is None and request.method == 'HEAD':
+            cache_key = self._page_key(request, 'HEAD')
+            response, state = self._get(cache_key)
+
+        if response is None:
+            request._cache_update_cache = True
+            return None
+
+        soft_expires = getattr(response, '_cache_soft_expires', None)
+        if soft_expires is not None and time.time() >= soft_expires:
+            lock_key = cache_key + '.lock'
+            if self.cache.add(lock_key, True, self.lock_seconds):
+                request._cache_update_cache = True
+                request._cache_lock_key = lock_key
+                return None
+            state = 'Stale'
+
+        slots = getattr(response, '_cache_slots', None)
+        if slots and any(is_fragment_slot(name) for start, end, name in slots):
+            fragments_started = timing.start()
+            fill_fragments(request, response, self.cache, self.key_prefix)
+            timing.record(request, 'fragments', fragments_started)
+
+        meta = getattr(response, '_cache_meta', None)
+        if meta is not None:
+            response['ETag'] = served_etag(request, meta)
+
+        encoding = getattr(response, '_cache_encoding', None)
+        if encoding is not None:
+            self._negotiate_encoding(request, response, encoding)
+
+        request._cache_update_cache = False
+        response['X-Cache-Middleware'] = state
         return response
 
+    def _not_modified(self, request, cache_key, if_none_match):
+        """Returns a 304 response if the client has the cached page, looked
+        up from the page metadata without loading the page"""
+        meta = None
+        if self.local_cache is not None:
+            entry = self.local_cache.get(cache_key)
+            if entry is not None and entry[2]:
+                meta = getattr(entry[0], '_cache_meta', None)
+        if meta is None:
+            meta = self.cache.get(cache_key + '.meta')
+            if meta is None:
+                return None
+        # Past the soft TTL the page may need revalidating
+        if meta['soft_expires'] is not None and time.time() >= meta['soft_expires']:
+            return None
+        etag = served_etag(request, meta)
+        if not etag_matches(if_none_match, etag):
+            return None
+
+        response = HttpResponseNotModified()
+        for header, value in meta['headers']:
+            response[header] = value
+        response['ETag'] = etag
+        response['X-Cache-Middleware'] = 'Not-Modified'
+        request._cache_update_cache = False
+        return response
+
+    def _page_key(self, request, method):
+        if self.local_cache is None:
+            return self.key_builder.get(request, self.key_prefix, method, self.cache)
+
+        # The header lists are kept in the local cache as well
+        header_key = self.key_builder.header_key(request, self.key_prefix)
+        entry = self.local_cache.get(header_key)
+        if entry is not None and entry[2]:
+            headerlist = entry[0]
+        else:
+            headerlist = self.cache.get(header_key)
+            if headerlist is None:
+                return None
+            self.local_cache.set(header_key, headerlist, None, sum(len(header) for header in headerlist))
+        return self.key_builder.page_key(request, method, headerlist, self.key_prefix)
+
+    def _get(self, cache_key):
+        """Returns the cached page and the hit state, or (None, None)"""
+        if self.local_cache is None:
+            return self.cache.get(cache_key), 'Hit'
+
+        entry = self.local_cache.get(cache_key)
+        if entry is not None:
+            response, version, fresh = entry
+            # Stale pages may have been revalidated by another process
+            soft_expires = getattr(response, '_cache_soft_expires', None)
+            if not fresh or (soft_expires is not None and time.time() >= soft_expires):
+                if self.cache.get(cache_key + '.version') == version:
+                    self.local_cache.touch(cache_key)
+                    fresh = True
+                else:
+                    # Updated or invalidated, look it up in the shared cache
+                    self.local_cache.delete(cache_key)
+                    fresh = False
+            if fresh:
+                return copy_response(response), 'Hit-L1'
+
+        response = self.cache.get(cache_key)
+        if response is None:
+            return None, None
+        version = getattr(response, '_cache_version', None)
+        if version is not None:
+            self.local_cache.set(cache_key, response, version, response_size(response))
+            response = copy_response(response)
+        return response, 'Hit-L2'
+
+    def _negotiate_encoding(self, request, response, encoding):
+        patch_vary_headers(response, ('Accept-Encoding',))
+        if accepts_encoding(request, encoding):
+            response['Content-Encoding'] = encoding
+            etag = response.get('ETag')
+            if etag and etag.startswith('"'):
+                response['ETag'] = 'W/' + etag
+        else:
+            response.content = COMPRESSORS[encoding][1](response.content)
+        if response.has_header('Content-Length'):
+            response['Content-Length'] = str(len(response.content))
+
     def process_response(self, request, response):
         if response.get('X-Cache-Middleware', '') == '':
-            response['X-Cache-Middleware'] = 'Miss'
+            if getattr(request, '_cache_lock_key', None) is not None:
+                response['X-Cache-Middleware'] = 'Revalidating'
+            else:
+                response['X-Cache-Middleware'] = 'Miss'
         return response
 
-class CsrfTokenUpdaterMiddleware(object):
+class CsrfTokenUpdaterMiddleware(MiddlewareMixin):
     '''
     Updates CSRF tokens to match the token contained in cookie. This way 
     pages can be safely cached. CsrfTokenUpdaterMiddleware should be run after the page is 
     feched from cache.
 
+    CustomUpdateCacheMiddleware records the offsets of the token when the
+    page is written to cache, and CustomFetchFromCacheMiddleware those of the
+    tokens in the fragments it fills in, so on a cache hit the token is
+    spliced in without scanning the content. Other responses are scanned once, streaming
+    responses chunk by chunk. In a stream the token is only recognized by the
+    csrfmiddlewaretoken input: occurrences more than STREAM_WINDOW bytes
+    before the first input (e.g. a <meta> tag in <head>) are streamed out
+    unchanged. Pages that need those replaced must not be streamed.
+
     Django 1.2
     '''
 
-    CSRFTOKEN_RE = re.compile(r'csrfmiddlewaretoken[^>]*value=(?:\'|")([a-z0-9]+)(?:\'|")', re.IGNORECASE)
+    # Enough to hold the token input tag while searching a stream for it
+    STREAM_WINDOW = 1024
 
     def process_response(self, request, response):
-        if response['Content-Type'].split(';')[0] in _HTML_TYPES:
-            print "processing..."
-            csrf_token = request.META.get("CSRF_COOKIE", None)
-            print "Cookie: " + str(csrf_token)
-            # If csrf_token is None, we have no token for this request, which probably
-            # means that this is a response from a request middleware.
-            if csrf_token is None:
-                return response
+        started = timing.start()
+        try:
+            return self._update_token(request, response)
+        finally:
+            timing.record(request, 'csrf', started)
+
+    def _update_token(self, request, response):
+        if not is_html(response):
+            return response
+
+        csrf_token = request.META.get("CSRF_COOKIE", None)
+        # If csrf_token is None, we have no token for this request, which probably
+        # means that this is a response from a request middleware.
+        if csrf_token is None:
+            return response
+
+        if getattr(response, 'streaming', False):
+            response.streaming_content = self._update_stream(response.streaming_content, csrf_token)
+            request.META["CSRF_COOKIE_USED"] = True
+            return response
+
+        content = response.content
+        slots = getattr(response, '_cache_slots', None)
+        if slots is None:
+            slots = response._cache_slots = find_csrf_slots(content)
+        if any(name == CSRF_SLOT and content[start:end] != csrf_token
+               for start, end, name in slots):
+            # Replace all CSRF tokens on response
+            response.content, response._cache_slots = splice_content(
+                content, slots, {CSRF_SLOT: csrf_token})
+            if response.has_header('Content-Length'):
+                response['Content-Length'] = str(len(response.content))
+            request.META["CSRF_COOKIE_USED"] = True
 
-            # Find the CSRF token used in cached content
-            token_match = self.CSRFTOKEN_RE.search(response.content)
-            if token_match: print "Match: " + token_match.group(1)
-            if token_match and token_match.group(1) != csrf_token:
-                print csrf_token
-                # Replace all CSRF tokens on response
-                response.content = mark_safe(response.content.replace(token_match.group(1), csrf_token))
-                request.META["CSRF_COOKIE_USED"] = True
-
-                # Since the content has been modified, any Etag will now be
-                # incorrect.  We could recalculate, but only if we assume that
-                # the Etag was set by CommonMiddleware. The safest thing is just
-                # to delete. See bug #9163
+            # Since the content has been modified, any Etag will now be
+            # incorrect.  We could recalculate, but only if we assume that
+            # the Etag was set by CommonMiddleware. The safest thing is just
+            # to delete. See bug #9163. The ETags of cached pages do not
+            # depend on the token, see served_etag.
+            if response.has_header('ETag') and getattr(response, '_cache_meta', None) is None:
                 del response['ETag']
         return response
 
+    def _update_stream(self, chunks, csrf_token):
+        """Replaces the CSRF token in a stream, keeping a tail of each chunk
+        so that a token split between two chunks is found as well. Until
+        the token input is found, only the last STREAM_WINDOW bytes are held
+        back, so earlier occurrences of the token are not replaced."""
+        token = None
+        tail = ''
+        for chunk in chunks:
+            data = tail + chunk
+            if token is None:
+                match = CSRFTOKEN_RE.search(data)
+                if match:
+                    token = match.group(1)
+            if token is not None and token != csrf_token:
+                data = data.replace(token, csrf_token)
+            keep = len(token) - 1 if token is not None else self.STREAM_WINDOW
+            if len(data) > keep:
+                tail = data[len(data) - keep:] if keep else ''
+                yield data[:len(data) - keep]
+            else:
+                tail = data
+        if tail:
+            yield tail
@@ -5,9 +5,444 @@ except ImportError:
 import pstats
 
 from cStringIO import StringIO
+from collections import defaultdict
+from contextlib import contextmanager
+from Queue import Empty, Full, Queue
+import errno
+import fcntl
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
 
+import django
+from django.conf import settings
+from django.db import connections
+from django.db.backends.utils import CursorWrapper
+from django.utils.encoding import force_bytes
 
-class ProfilerMiddleware(object):
+from protecomp.middleware import MiddlewareMixin
+
+logger = logging.getLogger(__name__)
+
+
+def view_name(request, callback):
+    """Returns the URL name of the view, or the dotted path of the callback"""
+    match = getattr(request, 'resolver_match', None)
+    if match is not None and match.view_name:
+        return match.view_name
+    return '%s.%s' % (callback.__module__, getattr(callback, '__name__', callback.__class__.__name__))
+
+
+class StackSampler(object):
+    """
+    Statistical profiler. A background thread samples the stacks of the
+    threads registered with start() every interval seconds and aggregates
+    them per view, as folded stacks ('frame;frame;frame count') readable by
+    flamegraph.pl and compatible tools.
+
+    If directory is given, the stacks are written there every flush_interval
+    seconds, one <view>.<pid>.folded file per view.
+    """
+    def __init__(self, interval=0.005, directory=None, flush_interval=60):
+        self.interval = interval
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.stacks = defaultdict(lambda: defaultdict(int))
+        self._active = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def start(self, name):
+        """Starts sampling the current thread for view name"""
+        with self._lock:
+            self._active[threading.current_thread().ident] = name
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='StackSampler')
+                self._thread.daemon = True
+                self._thread.start()
+        self._wakeup.set()
+
+    def stop(self):
+        with self._lock:
+            self._active.pop(threading.current_thread().ident, None)
+
+    def _run(self):
+        # Local references, module globals are cleared at interpreter shutdown
+        sleep, now, current_frames = time.sleep, time.time, sys._current_frames
+        flushed = now()
+        while True:
+            # Cleared before the check, so that a start() in between is not
+            # missed: either it is seen active or the wait returns at once
+            self._wakeup.clear()
+            if not self._active:
+                self._wakeup.wait(self.flush_interval)
+            sleep(self.interval)
+            self.sample(current_frames())
+            if self.directory and now() - flushed > self.flush_interval:
+                self.flush()
+                flushed = now()
+
+    def sample(self, frames):
+        with self._lock:
+            active = self._active.items()
+        for ident, name in active:
+            frame = frames.get(ident)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s:%s' % (frame.f_globals.get('__name__', code.co_filename), code.co_name))
+                frame = frame.f_back
+            stack.reverse()
+            with self._lock:
+                self.stacks[name][';'.join(stack)] += 1
+
+    def folded(self, name=None):
+        """Returns the folded stacks of view name, or of all views with the
+        view name as the root frame"""
+        with self._lock:
+            if name is not None:
+                return ''.join('%s %d\n' % item for item in sorted(self.stacks.get(name, {}).items()))
+            return ''.join('%s;%s %d\n' % (view, stack, count)
+                           for view, stacks in sorted(self.stacks.items())
+                           for stack, count in sorted(stacks.items()))
+
+    def flush(self):
+        for name in list(self.stacks):
+            filename = '%s.%d.folded' % (re.sub(r'[^\w.-]', '_', name), os.getpid())
+            path = os.path.join(self.directory, filename)
+            with open(path + '.tmp', 'w') as f:
+                f.write(self.folded(name))
+            os.rename(path + '.tmp', path)
+
+
+_sampler = None
+_sampler_lock = threading.Lock()
+
+
+def get_sampler():
+    """Returns the process-wide StackSampler, configured from settings"""
+    global _sampler
+    with _sampler_lock:
+        if _sampler is None:
+            _sampler = StackSampler(
+                interval=getattr(settings, 'PROFILER_SAMPLE_INTERVAL', 0.005),
+                directory=getattr(settings, 'PROFILER_SAMPLE_DIR', None),
+                flush_interval=getattr(settings, 'PROFILER_SAMPLE_FLUSH_INTERVAL', 60),
+            )
+        return _sampler
+
+
+class ProfileStore(object):
+    """
+    Merges the cProfile runs of each view into <directory>/<view>.prof, a
+    pstats file. When a file grows past max_bytes, it is rotated to
+    <view>.prof.1 and so on, keeping the given number of old files.
+
+    The number of merged requests is kept in <view>.prof.count, rotated
+    with the profile. Files are locked while they are merged, so several
+    processes can share the directory.
+
+    add() merges a profile synchronously. submit() queues it for a
+    background thread, which merges the profiles queued meanwhile into one
+    write per view. At most queue_size profiles wait in the queue, the rest
+    are dropped, and the queued ones are lost when the process exits.
+    """
+    SUFFIX = '.prof'
+    COUNT_SUFFIX = '.count'
+
+    def __init__(self, directory, max_bytes=10 * 1024 * 1024, keep=3, queue_size=1000):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.keep = keep
+        self._queue = Queue(queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def path(self, name):
+        return os.path.join(self.directory, re.sub(r'[^\w.-]', '_', name) + self.SUFFIX)
+
+    def add(self, name, profiler):
+        self.merge(name, pstats.Stats(profiler))
+
+    def submit(self, name, profiler):
+        """Queues the profile for the background thread"""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='ProfileStore')
+                self._thread.daemon = True
+                self._thread.start()
+        try:
+            self._queue.put_nowait((name, pstats.Stats(profiler), 1))
+        except Full:
+            pass
+
+    def join(self):
+        """Waits until the queued profiles are merged"""
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            items = [self._queue.get()]
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except Empty:
+                    break
+            pending = {}
+            for name, stats, requests in items:
+                if name in pending:
+                    pending[name][0].add(stats)
+                    pending[name][1] += requests
+                else:
+                    pending[name] = [stats, requests]
+            for name, (stats, requests) in pending.items():
+                try:
+                    self.merge(name, stats, requests)
+                except Exception:
+                    logger.exception("Could not store the profile of %s", name)
+            for item in items:
+                self._queue.task_done()
+
+    def merge(self, name, stats, requests=1):
+        """Merges pstats.Stats of the given number of requests into the file
+        of view name"""
+        path = self.path(name)
+        count_path = path + self.COUNT_SUFFIX
+        with open(path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.exists(path):
+                if os.path.getsize(path) > self.max_bytes:
+                    self.rotate(path)
+                    if os.path.exists(count_path):
+                        self.rotate(count_path)
+                else:
+                    stats.add(path)
+                    requests += read_count(count_path)
+            stats.dump_stats(path + '.tmp')
+            with open(count_path + '.tmp', 'w') as f:
+                f.write('%d\n' % requests)
+            os.rename(path + '.tmp', path)
+            os.rename(count_path + '.tmp', count_path)
+
+    def rotate(self, path):
+        for i in range(self.keep - 1, 0, -1):
+            try:
+                os.rename('%s.%d' % (path, i), '%s.%d' % (path, i + 1))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        if self.keep:
+            os.rename(path, path + '.1')
+        else:
+            os.remove(path)
+
+    def views(self):
+        """Returns a dict of view file name: pstats.Stats"""
+        return load_profiles(self.directory)
+
+
+def read_count(path):
+    """Returns the request count stored in path, or 0 if there is none"""
+    try:
+        with open(path) as f:
+            return int(f.read().strip() or 0)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return 0
+
+
+def load_profiles(directory):
+    """Returns a dict of view file name: pstats.Stats for the .prof files in
+    directory. The request count of each view is set to Stats.requests."""
+    profiles = {}
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith(ProfileStore.SUFFIX):
+            path = os.path.join(directory, filename)
+            stats = profiles[filename[:-len(ProfileStore.SUFFIX)]] = pstats.Stats(path)
+            stats.requests = read_count(path + ProfileStore.COUNT_SUFFIX)
+    return profiles
+
+
+def view_totals(stats):
+    """Returns (requests, cumulative seconds) of a view profile from
+    load_profiles. The time is the largest cumulative time of a function,
+    the view callback's."""
+    if not stats.stats:
+        return 0, 0.0
+    cc, nc, tt, ct, callers = max(stats.stats.values(), key=lambda entry: entry[3])
+    return getattr(stats, 'requests', 0), ct
+
+
+_store = None
+
+
+def get_profile_store():
+    """Returns the ProfileStore of settings.PROFILER_STORE_DIR, or None"""
+    global _store
+    directory = getattr(settings, 'PROFILER_STORE_DIR', None)
+    if not directory:
+        return None
+    if _store is None or _store.directory != directory:
+        _store = ProfileStore(
+            directory,
+            max_bytes=getattr(settings, 'PROFILER_STORE_MAX_BYTES', 10 * 1024 * 1024),
+            keep=getattr(settings, 'PROFILER_STORE_KEEP', 3),
+        )
+    return _store
+
+
+_SQL_LITERALS_RE = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b|%s")
+_SQL_LISTS_RE = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+_SQL_SPACE_RE = re.compile(r'\s+')
+
+# Frames in these directories are skipped when looking for the call site
+_LIBRARY_DIRS = (
+    os.path.dirname(django.__file__),
+    os.path.dirname(os.path.abspath(__file__)),
+)
+
+
+def normalize_sql(sql):
+    """Replaces literals and parameters with ? and IN-lists with (?)"""
+    sql = _SQL_LITERALS_RE.sub('?', sql)
+    sql = _SQL_LISTS_RE.sub('(?)', sql)
+    return _SQL_SPACE_RE.sub(' ', sql).strip()
+
+
+def call_site():
+    """Returns the innermost frame outside Django and this module"""
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if not filename.startswith(_LIBRARY_DIRS):
+            return '%s:%d in %s' % (filename, frame.f_lineno, frame.f_code.co_name)
+        frame = frame.f_back
+    return '?'
+
+
+class _RecordingCursorWrapper(CursorWrapper):
+    """Cursor wrapper for Django versions without execute_wrapper"""
+    def __init__(self, cursor, db, recorder):
+        super(_RecordingCursorWrapper, self).__init__(cursor, db)
+        self.recorder = recorder
+
+    def execute(self, sql, params=None):
+        start = time.time()
+        try:
+            return super(_RecordingCursorWrapper, self).execute(sql, params)
+        finally:
+            self.recorder.record(self.db.alias, sql, params, time.time() - start)
+
+    def executemany(self, sql, param_list):
+        start = time.time()
+        try:
+            return super(_RecordingCursorWrapper, self).executemany(sql, param_list)
+        finally:
+            self.recorder.record(self.db.alias, sql, None, time.time() - start, many=True)
+
+
+class QueryRecorder(object):
+    """
+    Records the database queries run while recording() is active: SQL,
+    parameters, duration and the call site. Works without DEBUG, using
+    connection.execute_wrapper, or on older Django versions a cursor
+    wrapper installed on the connections of the current thread.
+    """
+    def __init__(self):
+        self.queries = []
+
+    @property
+    def total_time(self):
+        return sum(query['time'] for query in self.queries)
+
+    def record(self, alias, sql, params, duration, many=False):
+        self.queries.append({
+            'alias': alias,
+            'sql': sql,
+            'params': params,
+            'many': many,
+            'time': duration,
+            'call_site': call_site(),
+        })
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.time()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.record(context['connection'].alias, sql, None if many else params,
+                        time.time() - start, many=many)
+
+    def _cursor_factory(self, connection, make_cursor):
+        return lambda cursor: _RecordingCursorWrapper(make_cursor(cursor), connection, self)
+
+    @contextmanager
+    def recording(self):
+        wrappers = []
+        patched = []
+        for connection in connections.all():
+            if hasattr(connection, 'execute_wrapper'):
+                wrapper = connection.execute_wrapper(self)
+                wrapper.__enter__()
+                wrappers.append(wrapper)
+            else:
+                connection.make_cursor = self._cursor_factory(connection, connection.make_cursor)
+                connection.make_debug_cursor = self._cursor_factory(connection, connection.make_debug_cursor)
+                patched.append(connection)
+        try:
+            yield self
+        finally:
+            for wrapper in reversed(wrappers):
+                wrapper.__exit__(None, None, None)
+            for connection in patched:
+                del connection.make_cursor
+                del connection.make_debug_cursor
+
+    def groups(self):
+        """Returns the queries grouped by normalized SQL, as a list of
+        (normalized sql, queries) sorted by total time"""
+        groups = defaultdict(list)
+        for query in self.queries:
+            groups[normalize_sql(query['sql'])].append(query)
+        return sorted(groups.items(), key=lambda group: -sum(query['time'] for query in group[1]))
+
+    def duplicates(self):
+        """Returns the number of queries repeating an earlier one exactly"""
+        seen = set()
+        duplicates = 0
+        for query in self.queries:
+            key = (query['alias'], query['sql'], repr(query['params']))
+            if key in seen:
+                duplicates += 1
+            seen.add(key)
+        return duplicates
+
+    def report(self):
+        lines = ['SQL: %d queries in %.1f ms, %d exact duplicates' % (
+            len(self.queries), 1000 * self.total_time, self.duplicates())]
+        groups = [group for group in self.groups() if len(group[1]) > 1]
+        if groups:
+            lines += ['', 'Similar queries:', '%8s %10s  %s' % ('count', 'total ms', 'sql')]
+            for sql, queries in groups:
+                lines.append('%8d %10.1f  %s' % (len(queries), 1000 * sum(q['time'] for q in queries), sql))
+                for site in sorted(set(query['call_site'] for query in queries)):
+                    lines.append('%20s from %s' % ('', site))
+        lines += ['', 'All queries:', '%8s  %s' % ('ms', 'sql')]
+        for query in self.queries:
+            lines.append('%8.1f  %s%s' % (1000 * query['time'], query['sql'], ' (many)' if query['many'] else ''))
+            lines.append('%10s%s %s' % ('', query['alias'], query['call_site']))
+        return '\n'.join(lines)
+
+
+class ProfilerMiddleware(MiddlewareMixin):
     """
     Simple profile middleware to profile django views. To run it, add ?prof to
     the URL like this:
@@ -18,29 +453,79 @@ class ProfilerMiddleware(object):
         See http://docs.python.org/2/library/profile.html#pstats.Stats.sort_stats
         for all sort options.
     ?count => The number of rows to display. Default is 100.
+    The database queries of the view are recorded by a QueryRecorder and
+    listed after the profile. Their count and total time in milliseconds are
+    set to the X-DB-Queries and X-DB-Time headers.
     This is adapted from an example found here:
     http://www.slideshare.net/zeeg/django-con-high-performance-django-presentation.
+
+    Sampling mode: set settings.PROFILER_SAMPLE_RATE to the fraction of
+    requests to sample, e.g. 0.01. The stacks of the sampled views are
+    collected by a StackSampler every settings.PROFILER_SAMPLE_INTERVAL
+    seconds (default 0.005) and written as folded stacks to
+    settings.PROFILER_SAMPLE_DIR, see get_sampler. The views run unprofiled,
+    so the overhead stays low enough for production traffic.
+
+    Profile store: if settings.PROFILER_STORE_DIR is set, ?prof runs are
+    merged per view into a ProfileStore. settings.PROFILER_STORE_RATE
+    profiles that fraction of the requests into the store without changing
+    the response. Those requests run under cProfile, typically about twice
+    as slow, and are merged into the store by a background thread, see
+    ProfileStore.submit. The view is called by Django as usual, so its
+    exceptions reach process_exception. See the profile_stats management
+    command.
     """
+    def __init__(self, get_response=None):
+        super(ProfilerMiddleware, self).__init__(get_response)
+        self.sample_rate = getattr(settings, 'PROFILER_SAMPLE_RATE', 0)
+        self.store_rate = getattr(settings, 'PROFILER_STORE_RATE', 0)
+
     def can(self, request):
         return 'prof' in request.GET
 
     def process_view(self, request, callback, callback_args, callback_kwargs):
         if self.can(request):
-            self.profiler = profile.Profile()
+            request._profiler = profile.Profile()
+            request._profiler_view = view_name(request, callback)
+            request._query_recorder = QueryRecorder()
             args = (request,) + callback_args
             try:
-                return self.profiler.runcall(callback, *args, **callback_kwargs)
+                with request._query_recorder.recording():
+                    return request._profiler.runcall(callback, *args, **callback_kwargs)
             except:
                 # we want the process_exception middleware to fire
                 # https://code.djangoproject.com/ticket/12250
                 return
+        if self.store_rate and random.random() < self.store_rate:
+            # Profiled until process_response, the view is called by Django
+            request._profiler = profile.Profile()
+            request._profiler_view = view_name(request, callback)
+            request._profiler.enable()
+            return
+        if self.sample_rate and random.random() < self.sample_rate:
+            request._profiler_sampler = get_sampler()
+            request._profiler_sampler.start(view_name(request, callback))
 
     def process_response(self, request, response):
-        if self.can(request):
-            self.profiler.create_stats()
+        sampler = getattr(request, '_profiler_sampler', None)
+        if sampler is not None:
+            sampler.stop()
+        profiler = getattr(request, '_profiler', None)
+        if profiler is not None:
+            profiler.create_stats()
+            store = get_profile_store()
+            if store is not None:
+                store.submit(request._profiler_view, profiler)
+        if profiler is not None and self.can(request):
             stream = StringIO()
-            stats = pstats.Stats(self.profiler, stream=stream)
+            stats = pstats.Stats(profiler, stream=stream)
             stats.sort_stats(request.GET.get('sort', 'time'))
             stats.print_stats(int(request.GET.get('count', 100)))
+            recorder = getattr(request, '_query_recorder', None)
+            if recorder is not None:
+                report = recorder.report().replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+                stream.write('\n%s\n' % force_bytes(report))
+                response['X-DB-Queries'] = str(len(recorder.queries))
+                response['X-DB-Time'] = '%.1f' % (1000 * recorder.total_time)
             response.content = '<pre>%s</pre>' % stream.getvalue()
         return response
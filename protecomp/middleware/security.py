@@ -1,16 +1,80 @@
 from django.http import HttpResponsePermanentRedirect
 from django.conf import settings
 
-class SecureRequiredMiddleware(object):
-    def __init__(self):
+from protecomp.middleware import MiddlewareMixin, timing
+
+import re
+
+
+def secure_url(request):
+    """Returns the absolute https URL of the request"""
+    request_url = request.build_absolute_uri(request.get_full_path())
+    return request_url.replace('http://', 'https://')
+
+
+class PathPrefixMatcher(object):
+    '''
+    Matches paths against a list of prefixes. The prefixes are compiled once
+    into a trie, which is turned into a single anchored regular expression
+    branching one character at a time, so a match does not scan the
+    prefixes one by one. Results are memoized per path, the memo is cleared
+    when it grows past memo_size.
+    '''
+
+    MEMO_SIZE = 4096
+
+    def __init__(self, prefixes, memo_size=MEMO_SIZE):
+        trie = {}
+        for prefix in prefixes:
+            node = trie
+            for char in prefix:
+                node = node.setdefault(char, {})
+            node[None] = True
+        self.regex = re.compile(self._pattern(trie))
+        self.memo_size = memo_size
+        self._memo = {}
+
+    def _pattern(self, node):
+        if None in node:
+            # Any path continuing from here matches a shorter prefix
+            return ''
+        branches = [re.escape(char) + self._pattern(child) for char, child in sorted(node.items())]
+        if not branches:
+            return '(?!)'
+        if len(branches) == 1:
+            return branches[0]
+        return '(?:%s)' % '|'.join(branches)
+
+    def match(self, path):
+        try:
+            return self._memo[path]
+        except KeyError:
+            pass
+        matched = self.regex.match(path) is not None
+        if len(self._memo) >= self.memo_size:
+            self._memo.clear()
+        self._memo[path] = matched
+        return matched
+
+
+class SecureRequiredMiddleware(MiddlewareMixin):
+    '''
+    Redirects requests to the paths starting with one of
+    settings.SECURE_REQUIRED_PATHS to https, if settings.HTTPS_SUPPORT is
+    set. The prefixes are matched against request.path with a
+    PathPrefixMatcher.
+    '''
+    def __init__(self, get_response=None):
+        super(SecureRequiredMiddleware, self).__init__(get_response)
         self.paths = getattr(settings, 'SECURE_REQUIRED_PATHS', None)
         self.enabled = self.paths and getattr(settings, 'HTTPS_SUPPORT', False)
+        self.matcher = PathPrefixMatcher(self.paths) if self.enabled else None
 
     def process_request(self, request):
-        if self.enabled and not request.is_secure():
-            for path in self.paths:
-                if request.get_full_path().startswith(path):
-                    request_url = request.build_absolute_uri(request.get_full_path())
-                    secure_url = request_url.replace('http://', 'https://')
-                    return HttpResponsePermanentRedirect(secure_url)
-        return None
\ No newline at end of file
+        started = timing.start()
+        try:
+            if self.enabled and not request.is_secure() and self.matcher.match(request.path):
+                return HttpResponsePermanentRedirect(secure_url(request))
+            return None
+        finally:
+            timing.record(request, 'secure', started)
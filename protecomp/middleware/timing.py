@@ -0,0 +1,152 @@
+"""
+Lightweight timing of the protecomp middlewares.
+
+Timing is off until ServerTimingMiddleware is installed. The middlewares
+time their phases with:
+
+    started = timing.start()
+    ...
+    timing.record(request, 'cache-fetch', started)
+
+When timing is off, start() returns None and record() returns at once, so
+the instrumented code allocates nothing. See benchmarks/timing_overhead.py.
+"""
+from collections import defaultdict
+import socket
+import threading
+
+try:
+    from time import monotonic as clock
+except ImportError:
+    # Python 2 has no monotonic clock
+    from time import time as clock
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from protecomp.middleware import MiddlewareMixin
+
+enabled = False
+
+
+def start():
+    """Returns the start time of a phase, or None if timing is off"""
+    if not enabled:
+        return None
+    return clock()
+
+
+def record(request, phase, started):
+    """Records the duration of phase, started at start()"""
+    if started is None:
+        return
+    duration = clock() - started
+    try:
+        request._timings.append((phase, duration))
+    except AttributeError:
+        request._timings = [(phase, duration)]
+
+
+class StatsdSink(object):
+    """
+    Sends histograms to statsd over UDP as timers with a sample rate, so that
+    each bucket counts as many samples. Configured with settings.STATSD_HOST,
+    STATSD_PORT and STATSD_PREFIX.
+    """
+    MAX_PACKET = 512
+
+    def __init__(self):
+        self.address = (getattr(settings, 'STATSD_HOST', 'localhost'),
+                        getattr(settings, 'STATSD_PORT', 8125))
+        self.prefix = getattr(settings, 'STATSD_PREFIX', 'django.timing')
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, histograms):
+        lines = []
+        for phase, buckets in sorted(histograms.items()):
+            for upper_ms, count in sorted(buckets.items()):
+                lines.append('%s.%s:%g|ms|@%g' % (self.prefix, phase, upper_ms, 1.0 / count))
+        packet = ''
+        for line in lines:
+            if packet and len(packet) + len(line) >= self.MAX_PACKET:
+                self._send(packet)
+                packet = ''
+            packet += line + '\n'
+        if packet:
+            self._send(packet)
+
+    def _send(self, packet):
+        try:
+            self.socket.sendto(packet.encode('ascii'), self.address)
+        except socket.error:
+            pass
+
+
+class TimingAggregator(object):
+    """
+    Collects the phase durations into histograms with exponential bucket
+    boundaries in milliseconds, and sends them to sink every
+    flush_interval seconds.
+    """
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    def __init__(self, sink, flush_interval=10):
+        self.sink = sink
+        self.flush_interval = flush_interval
+        self.histograms = defaultdict(lambda: defaultdict(int))
+        self.flushed = clock()
+        self._lock = threading.Lock()
+
+    def add(self, timings):
+        with self._lock:
+            for phase, duration in timings:
+                ms = duration * 1000
+                upper = next((bucket for bucket in self.BUCKETS if ms <= bucket), self.BUCKETS[-1])
+                self.histograms[phase][upper] += 1
+            if clock() - self.flushed < self.flush_interval:
+                return
+            histograms, self.histograms = self.histograms, defaultdict(lambda: defaultdict(int))
+            self.flushed = clock()
+        self.sink.send(histograms)
+
+
+class ServerTimingMiddleware(MiddlewareMixin):
+    """
+    Turns timing on, and adds the durations of the recorded phases and the
+    whole request in milliseconds to the Server-Timing header:
+
+        Server-Timing: cookies;dur=0.012, cache-fetch;dur=0.210, total;dur=1.532
+
+    Put it first in MIDDLEWARE (or MIDDLEWARE_CLASSES) so that total covers the other
+    middlewares. If settings.SERVER_TIMING_SINK is set, e.g. to
+    'protecomp.middleware.timing.StatsdSink', the timings are aggregated
+    and flushed to it every settings.SERVER_TIMING_FLUSH_INTERVAL seconds.
+    Set settings.SERVER_TIMING_HEADER to False to only aggregate.
+    """
+    def __init__(self, get_response=None):
+        super(ServerTimingMiddleware, self).__init__(get_response)
+        global enabled
+        enabled = True
+        self.header = getattr(settings, 'SERVER_TIMING_HEADER', True)
+        sink = getattr(settings, 'SERVER_TIMING_SINK', None)
+        if sink:
+            self.aggregator = TimingAggregator(
+                import_string(sink)(), getattr(settings, 'SERVER_TIMING_FLUSH_INTERVAL', 10))
+        else:
+            self.aggregator = None
+
+    def process_request(self, request):
+        request._timing_started = clock()
+
+    def process_response(self, request, response):
+        started = getattr(request, '_timing_started', None)
+        if started is None:
+            return response
+        record(request, 'total', started)
+        timings = request._timings
+        if self.header:
+            response['Server-Timing'] = ', '.join(
+                '%s;dur=%.3f' % (phase, duration * 1000) for phase, duration in timings)
+        if self.aggregator is not None:
+            self.aggregator.add(timings)
+        return response
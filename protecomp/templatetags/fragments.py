@@ -0,0 +1,27 @@
+from django import template
+from django.utils.safestring import mark_safe
+
+from protecomp.middleware.cache import fragment_marker, render_fragment
+
+register = template.Library()
+
+
+@register.simple_tag(takes_context=True)
+def fragment(context, template_name, timeout=0):
+    """
+    Renders a per-user region of a cacheable page from its own template:
+
+        {% load fragments %}
+        {% fragment "cart/count.html" 60 %}
+
+    The region is marked for CustomUpdateCacheMiddleware, which caches the
+    page without it. On a cache hit the template is rendered again for the
+    request, or taken from the per-user fragment cache for timeout seconds.
+    The template gets the context of the context processors only, so that
+    it renders the same from the view and from the cache middleware.
+
+    The page outside the fragments is still cached per user, see
+    share_response for caching it once for all users.
+    """
+    content = render_fragment(getattr(context, 'request', None), template_name)
+    return mark_safe(fragment_marker(template_name, timeout, content))
@@ -3,7 +3,9 @@ from distutils.core import setup
 setup(
     name='protecomp_django_extra',
     version='1.0',
-    packages=['protecomp', 'protecomp.fabric', 'protecomp.middleware'],
+    packages=['protecomp', 'protecomp.fabric', 'protecomp.middleware',
+              'protecomp.management', 'protecomp.management.commands',
+              'protecomp.templatetags'],
     url='',
     license='FreeBSD',
     author='Mikko Vilpponen',
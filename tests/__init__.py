@@ -0,0 +1,47 @@
+"""
+Tests of protecomp, run from the repository root:
+
+    python -m unittest discover -t . -s tests
+
+Django is configured here with locmem caches, cache-backed sessions and an
+in-memory SQLite database for the users. The Fabric tasks are run against
+local directories with a fake run(), see tests.remote.
+"""
+import os
+
+import django
+from django.conf import settings
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+
+if not settings.configured:
+    settings.configure(
+        DEBUG=False,
+        ALLOWED_HOSTS=['*'],
+        SECRET_KEY='tests',
+        ROOT_URLCONF='tests.urls',
+        INSTALLED_APPS=[
+            'django.contrib.contenttypes',
+            'django.contrib.auth',
+            'django.contrib.sessions',
+            'protecomp',
+        ],
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+        SESSION_ENGINE='django.contrib.sessions.backends.cache',
+        TEMPLATES=[{
+            'BACKEND': 'django.template.backends.django.DjangoTemplates',
+            'DIRS': [TEMPLATE_DIR],
+            'OPTIONS': {'context_processors': [
+                'django.template.context_processors.request',
+                'django.contrib.auth.context_processors.auth',
+            ]},
+        }],
+        USE_I18N=False,
+        USE_L10N=False,
+        CACHE_MIDDLEWARE_SECONDS=600,
+    )
+    django.setup()
+
+    from django.core.management import call_command
+    call_command('migrate', verbosity=0)
@@ -0,0 +1,66 @@
+"""
+Stand-ins for fabric's run, put, get and exists that work on the local
+file system, run runs the commands with bash in env.cwd. This way the
+deploy tasks can be tested against local directories and git repositories.
+"""
+from contextlib import contextmanager
+import os
+import shutil
+import subprocess
+
+from fabric.api import abort, env
+from fabric.operations import _AttributeString
+
+
+def local_run(command, *args, **kwargs):
+    if env.cwd:
+        command = 'cd %s && %s' % (env.cwd, command)
+    process = subprocess.Popen(['bash', '-c', command], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    stdout = process.communicate()[0]
+    output = _AttributeString(stdout.rstrip('\n'))
+    output.return_code = process.returncode
+    output.failed = process.returncode != 0
+    output.succeeded = not output.failed
+    if output.failed and not env.warn_only:
+        abort("run() received nonzero return code %s while executing '%s'" % (process.returncode, command))
+    return output
+
+
+def local_put(local_path, remote_path, *args, **kwargs):
+    if hasattr(local_path, 'read'):
+        with open(remote_path, 'wb') as f:
+            shutil.copyfileobj(local_path, f)
+    else:
+        shutil.copy(local_path, remote_path)
+
+
+def local_get(remote_path, local_path, *args, **kwargs):
+    if hasattr(local_path, 'write'):
+        with open(remote_path, 'rb') as f:
+            shutil.copyfileobj(f, local_path)
+    else:
+        shutil.copy(remote_path, local_path)
+
+
+def local_exists(path, *args, **kwargs):
+    return os.path.exists(path)
+
+
+STAND_INS = {'run': local_run, 'put': local_put, 'get': local_get, 'exists': local_exists}
+
+
+@contextmanager
+def fake_remote(*modules):
+    """Replaces run, put, get and exists in the modules with the local
+    stand-ins"""
+    originals = []
+    for module in modules:
+        for name, stand_in in STAND_INS.items():
+            if hasattr(module, name):
+                originals.append((module, name, getattr(module, name)))
+                setattr(module, name, stand_in)
+    try:
+        yield
+    finally:
+        for module, name, original in originals:
+            setattr(module, name, original)
@@ -0,0 +1,384 @@
+from collections import Counter
+import threading
+import time
+import unittest
+
+from django.contrib.auth.models import User
+from django.core.cache import cache, caches
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import Client, RequestFactory, SimpleTestCase, override_settings
+
+from protecomp.middleware import cache as cache_middleware
+from protecomp.middleware.cache import (
+    CacheKeyBuilder, CsrfTokenUpdaterMiddleware, accepts_encoding, find_csrf_slots, fragment_marker,
+    invalidate_tags, parse_accept_encoding, punch_fragments, tag_index_key,
+)
+
+
+class AcceptEncodingTest(unittest.TestCase):
+
+    def test_parse(self):
+        self.assertEqual(parse_accept_encoding('gzip, br;q=0.5, zstd;q=0'),
+                         (set(['gzip', 'br']), set(['zstd'])))
+
+    @override_settings(CACHE_MIDDLEWARE_ENCODINGS=('br', 'gzip'))
+    def test_canonical(self):
+        builder = CacheKeyBuilder()
+        self.assertEqual(builder.canonical_http_accept_encoding('gzip, br'), 'br')
+        self.assertEqual(builder.canonical_http_accept_encoding('gzip'), 'gzip')
+        self.assertEqual(builder.canonical_http_accept_encoding('deflate'), 'identity')
+        self.assertEqual(builder.canonical_http_accept_encoding('*'), 'br')
+
+    @override_settings(CACHE_MIDDLEWARE_ENCODINGS=('gzip',))
+    def test_wildcard_does_not_accept_refused(self):
+        builder = CacheKeyBuilder()
+        self.assertEqual(builder.canonical_http_accept_encoding('gzip;q=0, *'), 'identity')
+        self.assertEqual(builder.canonical_http_accept_encoding('*;q=0'), 'identity')
+        self.assertEqual(builder.canonical_http_accept_encoding('gzip, *;q=0'), 'gzip')
+
+    def test_accepts_encoding(self):
+        factory = RequestFactory()
+        self.assertTrue(accepts_encoding(factory.get('/', HTTP_ACCEPT_ENCODING='gzip'), 'gzip'))
+        self.assertTrue(accepts_encoding(factory.get('/', HTTP_ACCEPT_ENCODING='*'), 'gzip'))
+        self.assertFalse(accepts_encoding(factory.get('/', HTTP_ACCEPT_ENCODING='gzip;q=0, *'), 'gzip'))
+        self.assertFalse(accepts_encoding(factory.get('/'), 'gzip'))
+
+
+CACHE_MIDDLEWARE = [
+    'protecomp.middleware.cache.CustomUpdateCacheMiddleware',
+    'protecomp.middleware.cache.CustomFetchFromCacheMiddleware',
+]
+
+
+def concurrent_get(path, count):
+    """Requests path from count threads at once, returns the
+    X-Cache-Middleware states"""
+    start = threading.Event()
+    states = []
+
+    def get():
+        client = Client()
+        start.wait()
+        states.append(client.get(path)['X-Cache-Middleware'])
+
+    threads = [threading.Thread(target=get) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    start.set()
+    for thread in threads:
+        thread.join()
+    return states
+
+
+@override_settings(MIDDLEWARE=CACHE_MIDDLEWARE, CACHE_MIDDLEWARE_STALE_SECONDS=60)
+class StaleWhileRevalidateTest(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_one_request_revalidates(self):
+        path = '/page/?max_age=1&delay=0.3'
+        self.assertEqual(Client().get(path)['X-Cache-Middleware'], 'Miss')
+        self.assertEqual(Client().get(path)['X-Cache-Middleware'], 'Hit')
+        time.sleep(1.1)
+
+        states = Counter(concurrent_get(path, 20))
+        self.assertEqual(states, Counter({'Revalidating': 1, 'Stale': 19}))
+        self.assertEqual(Client().get(path)['X-Cache-Middleware'], 'Hit')
+
+
+class CountingCache(object):
+    """Wraps a cache and records the number of keys of each delete_many"""
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.deletes = []
+
+    def __getattr__(self, name):
+        return getattr(self.cache, name)
+
+    def delete_many(self, keys):
+        self.deletes.append(len(keys))
+        return self.cache.delete_many(keys)
+
+
+@override_settings(MIDDLEWARE=CACHE_MIDDLEWARE)
+class TagInvalidationTest(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def assertState(self, path, state):
+        self.assertEqual(Client().get(path)['X-Cache-Middleware'], state)
+
+    def test_invalidate(self):
+        paths = ['/tagged/?tag=x&page=%d' % i for i in range(5)] + ['/tagged/?tag=y']
+        for path in paths:
+            self.assertState(path, 'Miss')
+            self.assertState(path, 'Hit')
+
+        counting = CountingCache(cache)
+        self.assertEqual(invalidate_tags('x', cache=counting, batch_size=4), 5)
+        # 10 version and metadata keys, 5 pages and the index
+        self.assertEqual(counting.deletes, [4, 4, 2, 4, 1, 1])
+        for path in paths[:5]:
+            self.assertState(path, 'Miss')
+        self.assertState(paths[5], 'Hit')
+        self.assertEqual(invalidate_tags('x', 'z'), 5)
+        self.assertEqual(invalidate_tags('x'), 0)
+
+    def test_short_lived_page_keeps_index(self):
+        self.assertState('/tagged/?tag=x&max_age=3600', 'Miss')
+        self.assertState('/tagged/?tag=x&max_age=1', 'Miss')
+        time.sleep(1.2)
+        # The expired page is not counted
+        self.assertEqual(invalidate_tags('x'), 1)
+        self.assertState('/tagged/?tag=x&max_age=3600', 'Miss')
+
+    def test_expired_keys_pruned(self):
+        self.assertState('/tagged/?tag=x&max_age=1', 'Miss')
+        time.sleep(1.2)
+        self.assertState('/tagged/?tag=x&max_age=3600', 'Miss')
+        self.assertEqual(len(cache.get(tag_index_key('x'))), 1)
+
+
+@override_settings(MIDDLEWARE=CACHE_MIDDLEWARE, CACHE_MIDDLEWARE_STALE_SECONDS=60)
+class NotModifiedTest(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def record_gets(self):
+        """Returns the list of keys read from the cache from now on"""
+        gets = []
+        backend = type(caches['default'])
+        original = backend.get
+
+        def get(self, key, *args, **kwargs):
+            gets.append(key)
+            return original(self, key, *args, **kwargs)
+
+        backend.get = get
+        self.addCleanup(setattr, backend, 'get', original)
+        return gets
+
+    def test_not_modified_from_meta(self):
+        client = Client()
+        etag = client.get('/page/')['ETag']
+        gets = self.record_gets()
+        response = client.get('/page/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['X-Cache-Middleware'], 'Not-Modified')
+        self.assertEqual(response['ETag'], etag)
+        # Only the header list and the metadata, not the page
+        self.assertEqual(len(gets), 2)
+        self.assertTrue(gets[1].endswith('.meta'))
+
+    @override_settings(MIDDLEWARE=[
+        'django.middleware.csrf.CsrfViewMiddleware',
+        'protecomp.middleware.cache.CustomUpdateCacheMiddleware',
+        'protecomp.middleware.cache.CsrfTokenUpdaterMiddleware',
+        'protecomp.middleware.cache.CustomFetchFromCacheMiddleware',
+    ])
+    def test_etag_per_csrf_token(self):
+        etags = {}
+        for token, states in (('a' * 64, ('Miss', 'Hit')), ('b' * 64, ('Hit', 'Hit'))):
+            client = Client()
+            client.cookies['csrftoken'] = token
+            for state in states:
+                response = client.get('/form/')
+                self.assertEqual(response['X-Cache-Middleware'], state)
+                self.assertIn('value="%s"' % token, response.content)
+                self.assertEqual(etags.setdefault(token, response['ETag']), response['ETag'])
+            other = etags['a' * 64]
+            response = client.get('/form/', HTTP_IF_NONE_MATCH=other)
+            self.assertEqual(response.status_code, 304 if other == etags[token] else 200)
+
+        # The same page, with a part for the token
+        first, second = etags['a' * 64], etags['b' * 64]
+        self.assertNotEqual(first, second)
+        self.assertEqual(first.rsplit('-', 1)[0], second.rsplit('-', 1)[0])
+
+    def test_no_not_modified_when_outdated(self):
+        path = '/tagged/?tag=x&max_age=1'
+        client = Client()
+        etag = client.get(path)['ETag']
+        self.assertEqual(client.get(path, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        time.sleep(1.1)
+        response = client.get(path, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual((response.status_code, response['X-Cache-Middleware']), (200, 'Revalidating'))
+        self.assertEqual(client.get(path, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        self.assertEqual(invalidate_tags('x'), 1)
+        response = client.get(path, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual((response.status_code, response['X-Cache-Middleware']), (200, 'Miss'))
+
+
+@override_settings(MIDDLEWARE=[
+    'django.middleware.csrf.CsrfViewMiddleware',
+    'protecomp.middleware.cache.CustomUpdateCacheMiddleware',
+    'protecomp.middleware.cache.CsrfTokenUpdaterMiddleware',
+    'django.middleware.common.CommonMiddleware',
+    'protecomp.middleware.cache.CustomFetchFromCacheMiddleware',
+])
+class CsrfTokenUpdaterTest(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_hit_spliced_without_scan(self):
+        first = Client()
+        first.cookies['csrftoken'] = 'a' * 64
+        self.assertEqual(first.get('/form/')['X-Cache-Middleware'], 'Miss')
+
+        scans = []
+        find_csrf_slots = cache_middleware.find_csrf_slots
+        cache_middleware.find_csrf_slots = lambda content: scans.append(content) or find_csrf_slots(content)
+        self.addCleanup(setattr, cache_middleware, 'find_csrf_slots', find_csrf_slots)
+
+        second = Client()
+        second.cookies['csrftoken'] = 'b' * 64
+        response = second.get('/form/')
+        self.assertEqual(response['X-Cache-Middleware'], 'Hit')
+        self.assertIn('value="%s"' % ('b' * 64), response.content)
+        self.assertNotIn('a' * 64, response.content)
+        self.assertEqual(response['Content-Length'], str(len(response.content)))
+        self.assertEqual(scans, [])
+
+    def test_recorded_slots_resized(self):
+        # A token of another length, e.g. from a page cached by an older
+        # Django version
+        old, new = 'a' * 32, 'b' * 64
+        response = HttpResponse('<input name="csrfmiddlewaretoken" value="%s"><p>%s</p>' % (old, old))
+        response['Content-Length'] = str(len(response.content))
+        response._cache_slots = find_csrf_slots(response.content)
+        request = RequestFactory().get('/')
+        request.META['CSRF_COOKIE'] = new
+        response = CsrfTokenUpdaterMiddleware().process_response(request, response)
+        self.assertEqual(response.content, '<input name="csrfmiddlewaretoken" value="%s"><p>%s</p>' % (new, new))
+        self.assertEqual(response['Content-Length'], str(len(response.content)))
+        self.assertEqual(response._cache_slots, find_csrf_slots(response.content))
+
+    def test_token_split_between_chunks(self):
+        old, new = 'a' * 64, 'b' * 64
+        page = '<html><form><input name="csrfmiddlewaretoken" value="%s"></form><p>%s</p></html>' % (old, old)
+        # Every split of the input's token, and of the later occurrence
+        for split in range(page.index(old), len(page)):
+            request = RequestFactory().get('/')
+            request.META['CSRF_COOKIE'] = new
+            response = StreamingHttpResponse(iter([page[:split], page[split:]]))
+            response = CsrfTokenUpdaterMiddleware().process_response(request, response)
+            self.assertEqual(''.join(response.streaming_content), page.replace(old, new))
+
+
+@override_settings(MIDDLEWARE=CACHE_MIDDLEWARE, CACHE_MIDDLEWARE_STALE_SECONDS=60,
+                   CACHE_MIDDLEWARE_L1_BYTES=100000, CACHE_MIDDLEWARE_COMPRESS=('gzip',))
+class LocalPageCacheTest(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def get(self, client, path):
+        return client.get(path, HTTP_ACCEPT_ENCODING='gzip')['X-Cache-Middleware']
+
+    def test_revalidated_page_from_l2(self):
+        # Two clients have their own handlers, like two processes
+        first, second = Client(), Client()
+        path = '/page/?max_age=1'
+        self.assertEqual(self.get(first, path), 'Miss')
+        self.assertEqual(self.get(second, path), 'Hit-L2')
+        self.assertEqual(self.get(second, path), 'Hit-L1')
+        time.sleep(1.1)
+
+        self.assertEqual(self.get(first, path), 'Revalidating')
+        # The L1 entry of the second process is outdated
+        self.assertEqual(self.get(second, path), 'Hit-L2')
+        self.assertEqual(self.get(second, path), 'Hit-L1')
+
+    def test_invalidated_page_not_served_from_l1(self):
+        first, second = Client(), Client()
+        path = '/tagged/?tag=x&max_age=1'
+        self.assertEqual(self.get(first, path), 'Miss')
+        self.assertEqual(self.get(second, path), 'Hit-L2')
+        time.sleep(1.1)
+
+        self.assertEqual(invalidate_tags('x'), 1)
+        self.assertEqual(self.get(second, path), 'Miss')
+
+
+@override_settings(MIDDLEWARE=[
+    'protecomp.middleware.cache.CustomUpdateCacheMiddleware',
+    'django.contrib.sessions.middleware.SessionMiddleware',
+    'protecomp.middleware.cache.CustomFetchFromCacheMiddleware',
+])
+class FragmentTest(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def login(self, name):
+        client = Client()
+        client.get('/login/?name=%s' % name)
+        return client
+
+    def test_shared_page(self):
+        for name, first_state in (('alice', 'Miss'), ('bob', 'Hit')):
+            client = self.login(name)
+            for state in (first_state, 'Hit'):
+                response = client.get('/fragment/?share')
+                self.assertEqual(response['X-Cache-Middleware'], state)
+                self.assertIn('Hello %s' % name, response.content)
+                self.assertIn('Cookie', response['Vary'])
+
+        response = Client().get('/fragment/?share')
+        self.assertEqual(response['X-Cache-Middleware'], 'Hit')
+        self.assertIn('Hello anonymous', response.content)
+
+    def test_forged_markers_left_alone(self):
+        forged = '<!--protecomp:fragment login_box.html 0 0123abcd-->'
+        forged_end = '<!--/protecomp:fragment 0123abcd-->'
+        content = forged + fragment_marker('fragment_user.html', 0, 'Hi') + forged_end
+        live, punched, slots = punch_fragments(content)
+        self.assertEqual(live, forged + 'Hi' + forged_end)
+        self.assertEqual(punched, forged + forged_end)
+        self.assertEqual(slots, [(len(forged), len(forged), ('fragment', 'fragment_user.html', 0))])
+
+        comment = forged + 'secret' + forged_end
+        client = self.login('alice')
+        for state in ('Miss', 'Hit'):
+            response = client.get('/fragment/', {'comment': comment})
+            self.assertEqual(response['X-Cache-Middleware'], state)
+            self.assertIn('<p>%s</p>' % comment, response.content)
+            self.assertNotIn('Logged in as', response.content)
+
+    def test_page_per_session_by_default(self):
+        for name in ('alice', 'bob'):
+            client = self.login(name)
+            self.assertEqual(client.get('/fragment/')['X-Cache-Middleware'], 'Miss')
+            response = client.get('/fragment/')
+            self.assertEqual(response['X-Cache-Middleware'], 'Hit')
+            self.assertIn('Hello %s' % name, response.content)
+
+
+@override_settings(MIDDLEWARE=[
+    'protecomp.middleware.cache.CustomUpdateCacheMiddleware',
+    'django.contrib.sessions.middleware.SessionMiddleware',
+    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'protecomp.middleware.cache.CustomFetchFromCacheMiddleware',
+])
+class AuthFragmentTest(SimpleTestCase):
+    allow_database_queries = True
+
+    def setUp(self):
+        cache.clear()
+        User.objects.all().delete()
+
+    def test_user_outside_fragment_not_shared(self):
+        for name in ('alice', 'bob'):
+            client = Client()
+            client.force_login(User.objects.create_user(name))
+            self.assertEqual(client.get('/user/')['X-Cache-Middleware'], 'Miss')
+            response = client.get('/user/')
+            self.assertEqual(response['X-Cache-Middleware'], 'Hit')
+            self.assertIn('Logged in as %s' % name, response.content)
+            self.assertIn('<p>%s</p>' % name, response.content)
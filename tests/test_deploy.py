@@ -0,0 +1,296 @@
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from django.test.utils import captured_stdout
+from fabric.api import hide, settings
+
+from protecomp.fabric import deploy, server_settings, static, timing
+from tests.remote import fake_remote
+
+
+GIT_ENVIRON = dict(
+    os.environ,
+    GIT_AUTHOR_NAME='test', GIT_AUTHOR_EMAIL='test@example.com',
+    GIT_COMMITTER_NAME='test', GIT_COMMITTER_EMAIL='test@example.com',
+)
+
+
+def sh(command, cwd):
+    return subprocess.check_output(['bash', '-c', command], cwd=cwd, stderr=subprocess.STDOUT, env=GIT_ENVIRON)
+
+
+def write(path, content):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def git_repository(path):
+    os.makedirs(path)
+    sh('git init -q', path)
+
+
+def commit(path, filename, content):
+    write(os.path.join(path, filename), content)
+    sh('git add -A && git commit -q -m %s' % filename, path)
+
+
+class DeployTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.settings = settings(hide('everything', 'aborts'), host='media.example.com',
+                                 host_string='media.example.com')
+        self.settings.__enter__()
+        self.addCleanup(self.settings.__exit__, None, None, None)
+        # No timing summary or deploy history from the tests
+        self.addCleanup(self.clear_timings)
+        remote = fake_remote(deploy)
+        remote.__enter__()
+        self.addCleanup(remote.__exit__, None, None, None)
+
+    def clear_timings(self):
+        del timing.records[:]
+
+    def path(self, *parts):
+        return os.path.join(self.directory, *parts)
+
+
+class CollectstaticIncrementalTest(DeployTestCase):
+
+    def setUp(self):
+        super(CollectstaticIncrementalTest, self).setUp()
+        git_repository(self.path('origin'))
+        commit(self.path('origin'), 'assets/app.js', 'app')
+        commit(self.path('origin'), 'requirements.txt', 'Django==1.11\n')
+        sh('git clone -q origin local && git clone -q origin remote', self.directory)
+        self.install_requirements()
+        collected = []
+
+        def collectstatic(command):
+            # Copies the assets of the local working copy to STATIC_ROOT
+            collected.append(command)
+            shutil.rmtree(self.path('collected'), ignore_errors=True)
+            shutil.copytree(self.path('local', 'assets'), self.path('collected'))
+
+        manage, deploy.util.manage = deploy.util.manage, collectstatic
+        self.addCleanup(setattr, deploy.util, 'manage', manage)
+        self.addCleanup(deploy._static_manifests.clear)
+        self.settings = settings(
+            local_base=self.path('local'),
+            local_static_root=self.path('collected'),
+            remote_base=self.path('remote'),
+            virtualenv='venv',
+            static_root='static',
+            pip_requirements='requirements.txt',
+        )
+        self.settings.__enter__()
+        self.addCleanup(self.settings.__exit__, None, None, None)
+
+    def install_requirements(self):
+        # As left by update_requirements
+        sh('mkdir -p venv && sha1sum requirements.txt | cut -c1-40 > venv/.requirements-sha1', self.path('remote'))
+
+    def deploy_static(self, **kwargs):
+        deploy._static_manifests.clear()
+        with captured_stdout() as stdout:
+            deploy.collectstatic_incremental(**kwargs)
+        return stdout.getvalue()
+
+    def test_upload(self):
+        self.assertIn('Uploading 1 changed files', self.deploy_static())
+        self.assertEqual(os.listdir(self.path('remote', 'static')), ['app.js'])
+        with open(self.path('remote', 'venv', static.MANIFEST_NAME)) as f:
+            self.assertEqual(list(json.load(f)), ['app.js'])
+        self.assertIn('up to date', self.deploy_static())
+
+        commit(self.path('origin'), 'assets/app.css', 'css')
+        sh('git pull -q', self.path('local'))
+        sh('git pull -q', self.path('remote'))
+        self.assertIn('Uploading 1 changed files', self.deploy_static())
+        self.assertEqual(sorted(os.listdir(self.path('remote', 'static'))), ['app.css', 'app.js'])
+
+    def test_refuses_dirty_working_copy(self):
+        write(self.path('local', 'assets', 'debug.js'), 'debug')
+        self.assertRaises(SystemExit, self.deploy_static)
+        self.assertFalse(os.path.exists(self.path('remote', 'static')))
+        self.assertIn('Uploading 2 changed files', self.deploy_static(force='true'))
+
+    def test_refuses_other_requirements(self):
+        commit(self.path('origin'), 'requirements.txt', 'Django==1.11.29\n')
+        sh('git pull -q', self.path('local'))
+        sh('git pull -q', self.path('remote'))
+        self.assertRaises(SystemExit, self.deploy_static)
+        self.assertFalse(os.path.exists(self.path('remote', 'static')))
+        self.install_requirements()
+        self.assertIn('Uploading 1 changed files', self.deploy_static())
+
+    def test_refuses_other_revision(self):
+        commit(self.path('local'), 'assets/local.js', 'local')
+        self.assertRaises(SystemExit, self.deploy_static)
+        self.assertFalse(os.path.exists(self.path('remote', 'static')))
+
+
+class CheckoutTest(DeployTestCase):
+
+    def setUp(self):
+        super(CheckoutTest, self).setUp()
+        git_repository(self.path('work'))
+        for i in range(3):
+            commit(self.path('work'), 'file%d' % i, 'content')
+        sh('git clone -q --bare work origin.git && git clone -q file://%s/origin.git deployed' % self.directory,
+           self.directory)
+        for i in range(3, 6):
+            commit(self.path('work'), 'file%d' % i, 'content')
+        sh('git push -q %s master' % self.path('origin.git'), self.path('work'))
+        self.settings = settings(repository_roots={'project': self.path('deployed')})
+        self.settings.__enter__()
+        self.addCleanup(self.settings.__exit__, None, None, None)
+
+    def head(self, ref='HEAD'):
+        return sh('git rev-parse %s' % ref, self.path('deployed')).strip()
+
+    def checkout(self, **kwargs):
+        with captured_stdout():
+            deploy.checkout('master', **kwargs)
+
+    def test_fast_forward(self):
+        self.checkout()
+        self.assertEqual(self.head(), self.head('origin/master'))
+
+    def test_depth(self):
+        self.checkout(depth=1, reset='true')
+        self.assertEqual(self.head(), self.head('origin/master'))
+        self.assertTrue(os.path.exists(self.path('deployed', 'file5')))
+
+    def test_depth_requires_reset(self):
+        before = self.head()
+        self.assertRaises(SystemExit, self.checkout, depth=1)
+        self.assertEqual(self.head(), before)
+        self.assertFalse(os.path.exists(self.path('deployed', '.git', 'shallow')))
+
+
+# Records its arguments in calls.log, lists one pending migration
+FAKE_MANAGE = """import os, sys
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'calls.log'), 'a') as log:
+    log.write(' '.join(sys.argv[1:]) + '\\n')
+if sys.argv[1:2] == ['showmigrations']:
+    print(' [X] auth.0001_initial')
+    print(' [ ] app.0002_change')
+elif sys.argv[1:2] == ['migrate']:
+    print('  Applying app.0002_change... OK (0.010s)')
+"""
+
+
+class MigrateTest(DeployTestCase):
+
+    def setUp(self):
+        super(MigrateTest, self).setUp()
+        write(self.path('project', 'manage.py'), FAKE_MANAGE)
+        write(self.path('project', 'venv', 'bin', 'activate'), '')
+        write(self.path('project', 'app', 'migrations', '0001_initial.py'), '')
+        self.package_migrations = self.path('project', 'venv', 'lib', 'site-packages', 'package', 'migrations')
+        write(os.path.join(self.package_migrations, '0001_initial.py'), '')
+        self.settings = settings(remote_base=self.path('project'), virtualenv='venv', manage='manage.py',
+                                 static_root='static')
+        self.settings.__enter__()
+        self.addCleanup(self.settings.__exit__, None, None, None)
+
+    def migrate(self, **kwargs):
+        with captured_stdout() as stdout:
+            deploy.migrate(**kwargs)
+        return stdout.getvalue()
+
+    def migrate_calls(self):
+        with open(self.path('project', 'calls.log')) as f:
+            return [line for line in f.read().splitlines() if line.startswith('migrate')]
+
+    def test_skip_unchanged(self):
+        output = self.migrate()
+        self.assertIn('app.0002_change', output)
+        self.assertEqual(len(self.migrate_calls()), 1)
+        self.assertIn('skipping', self.migrate())
+        self.assertEqual(len(self.migrate_calls()), 1)
+
+        write(self.path('project', 'app', 'migrations', '0002_change.py'), '')
+        self.migrate()
+        self.assertEqual(len(self.migrate_calls()), 2)
+        self.assertIn('Migrated', self.migrate(force='true'))
+        self.assertEqual(len(self.migrate_calls()), 3)
+
+    def test_static_root_and_repository_skipped(self):
+        self.migrate()
+        write(self.path('project', 'static', 'package', 'migrations', '0002_upgrade.py'), '')
+        write(self.path('project', '.git', 'package', 'migrations', '0002_upgrade.py'), '')
+        self.assertIn('skipping', self.migrate())
+
+    def test_package_migrations(self):
+        self.migrate()
+        write(os.path.join(self.package_migrations, '0002_upgrade.py'), '')
+        self.assertNotIn('skipping', self.migrate())
+        self.assertEqual(len(self.migrate_calls()), 2)
+
+
+class RollingTest(DeployTestCase):
+
+    def setUp(self):
+        super(RollingTest, self).setUp()
+        log = self.path('reloads.log')
+        self.broken = self.path('broken')
+        hosts = ['a', 'b', 'c', 'd']
+        self.settings = settings(
+            all_hosts=hosts,
+            hostinfo={},
+            processes={'app-server': {'django': {
+                'reload': 'echo reloaded >> %s' % log,
+                'status': 'test ! -f %s' % self.broken,
+            }}},
+            health_check_timeout=0.2,
+            health_check_interval=0.05,
+        )
+        self.settings.__enter__()
+        self.addCleanup(self.settings.__exit__, None, None, None)
+        server_settings.get_roledefs(dict((host, {'app-server': True}) for host in hosts))
+
+    def reloads(self):
+        if not os.path.exists(self.path('reloads.log')):
+            return 0
+        with open(self.path('reloads.log')) as f:
+            return len(f.readlines())
+
+    def rolling_reload(self, **kwargs):
+        with captured_stdout() as stdout:
+            deploy._rolling('reload', (), **kwargs)
+        return stdout.getvalue()
+
+    def test_batches(self):
+        output = self.rolling_reload(min_capacity=50)
+        self.assertIn('Batch 1/2: a, b', output)
+        self.assertIn('Batch 2/2: c, d', output)
+        self.assertEqual(self.reloads(), 4)
+
+        output = self.rolling_reload()
+        self.assertIn('Batch 4/4: d', output)
+        self.assertEqual(self.reloads(), 8)
+
+    def test_capacity_kept(self):
+        with settings(all_hosts=['a', 'b']):
+            with self.assertRaises(SystemExit):
+                self.rolling_reload()
+            self.assertEqual(self.reloads(), 0)
+            self.assertIn('Batch 2/2: b', self.rolling_reload(min_capacity=50))
+
+    def test_stops_when_not_healthy(self):
+        write(self.broken, '')
+        with captured_stdout() as stdout:
+            with self.assertRaises(SystemExit):
+                deploy._rolling('reload', (), min_capacity=50)
+        self.assertIn('Failed on 2 of 2 hosts', stdout.getvalue())
+        self.assertNotIn('Batch 2/2', stdout.getvalue())
+        self.assertEqual(self.reloads(), 2)
@@ -0,0 +1,64 @@
+import unittest
+
+from django.test.utils import captured_stdout
+from fabric.api import env, hide, settings
+
+from protecomp.fabric import parallel
+from tests.remote import local_run
+
+
+def echo_host(failing):
+    print "working on %s" % env.host
+    output = local_run('echo %s' % env.host)
+    if env.host == failing:
+        local_run('exit 3')
+    return output
+
+
+class RunOnHostsTest(unittest.TestCase):
+
+    def test_one_failing_host(self):
+        hosts = ['a', 'b', 'c', 'd']
+        finished = []
+        results = parallel.run_on_hosts(echo_host, hosts, ('b',), pool_size=2,
+                                        callback=lambda result: finished.append(result.host))
+
+        self.assertEqual([result.host for result in results], hosts)
+        self.assertEqual(sorted(finished), hosts)
+        self.assertEqual([result.failed for result in results], [False, True, False, False])
+        self.assertEqual([result.result for result in results], ['a', None, 'c', 'd'])
+        failed = results[1]
+        self.assertEqual(failed.error, 'aborted')
+        self.assertIn('working on b', failed.output)
+        self.assertIn('nonzero return code 3', failed.output)
+        self.assertIn('working on a', results[0].output)
+        self.assertNotIn('working on b', results[0].output)
+        with captured_stdout() as stdout:
+            self.assertFalse(parallel.report(results))
+            self.assertTrue(parallel.report([results[0]]))
+        self.assertIn('Failed on 1 of 4 hosts', stdout.getvalue())
+
+    def test_exception(self):
+        def fail():
+            raise ValueError('broken')
+        results = parallel.run_on_hosts(fail, ['a'])
+        self.assertEqual(results[0].error, 'ValueError: broken')
+        self.assertIn('Traceback', results[0].output)
+
+    def test_multihost(self):
+        calls = []
+        task = parallel.multihost(lambda: env.host)
+        hosts = ['a', 'b', 'c']
+        with settings(all_hosts=hosts, parallel_pool_size=3):
+            with captured_stdout():
+                for host in hosts:
+                    with settings(host_string=host, host=host):
+                        calls.append(task())
+        self.assertEqual(calls, hosts)
+
+    def test_multihost_aborts_on_failure(self):
+        task = parallel.multihost(lambda: echo_host('b'))
+        with settings(hide('aborts'), all_hosts=['a', 'b'], parallel_pool_size=2, host_string='a', host='a'):
+            with captured_stdout() as stdout:
+                self.assertRaises(SystemExit, task)
+        self.assertIn('b:\tFAILED', stdout.getvalue())
@@ -0,0 +1,72 @@
+import cProfile
+import os
+import shutil
+import tempfile
+import unittest
+
+from django.test import Client, SimpleTestCase, override_settings
+
+from protecomp.middleware.profiler import ProfileStore, get_profile_store, load_profiles, view_totals
+from tests import views
+
+
+class ProfileStoreRateTest(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.settings = override_settings(
+            MIDDLEWARE=['protecomp.middleware.profiler.ProfilerMiddleware'],
+            PROFILER_STORE_DIR=self.directory,
+            PROFILER_STORE_RATE=1.0,
+        )
+        self.settings.enable()
+        self.addCleanup(self.settings.disable)
+        self.addCleanup(lambda: get_profile_store().join())
+        del views.failing_calls[:]
+
+    def test_view_called_once(self):
+        with self.assertRaises(ValueError):
+            Client().post('/failing/')
+        self.assertEqual(views.failing_calls, ['POST'])
+
+    def test_profiles_stored(self):
+        client = Client()
+        for i in range(3):
+            client.get('/page/')
+        get_profile_store().join()
+        profiles = load_profiles(self.directory)
+        self.assertEqual(list(profiles), ['tests.views.page'])
+        self.assertEqual(view_totals(profiles['tests.views.page'])[0], 3)
+        self.assertTrue(os.path.exists(os.path.join(self.directory, 'tests.views.page.prof')))
+
+
+class ProfileStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def profile(self):
+        # One request calling the same function twice
+        profiler = cProfile.Profile()
+        profiler.enable()
+        sorted(range(100))
+        sorted(range(100))
+        profiler.disable()
+        return profiler
+
+    def test_request_count(self):
+        store = ProfileStore(self.directory)
+        store.add('view', self.profile())
+        self.assertEqual(view_totals(load_profiles(self.directory)['view'])[0], 1)
+        store.add('view', self.profile())
+        self.assertEqual(view_totals(load_profiles(self.directory)['view'])[0], 2)
+
+    def test_count_rotated(self):
+        store = ProfileStore(self.directory, max_bytes=0, keep=1)
+        store.add('view', self.profile())
+        store.add('view', self.profile())
+        self.assertEqual(view_totals(load_profiles(self.directory)['view'])[0], 1)
+        with open(os.path.join(self.directory, 'view.prof.count.1')) as f:
+            self.assertEqual(f.read(), '1\n')
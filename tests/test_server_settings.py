@@ -0,0 +1,39 @@
+import unittest
+
+from fabric.api import env, settings
+
+from protecomp.fabric import server_settings, util
+
+
+class HostIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.django = util.supervisor_process('django')
+        self.worker = util.supervisor_process('celery')
+        self.settings = settings(hostinfo={}, processes={'app-server': {'django': self.django}, 'w': {'celery': self.worker}})
+        self.settings.__enter__()
+        self.addCleanup(self.settings.__exit__, None, None, None)
+        server_settings.get_roledefs({'a': {'app-server': True}, 'b': {'app-server': True, 'w': True}})
+
+    def test_lookups(self):
+        self.assertEqual(util.get_processes('a'), [self.django])
+        self.assertItemsEqual(util.get_processes('b'), [self.django, self.worker])
+        self.assertEqual(util.get_processes('b', ['celery']), [self.worker])
+        self.assertItemsEqual(server_settings.get_roles_for_host('b'), ['app-server', 'w'])
+
+    def test_in_place_changes(self):
+        util.get_processes('a')
+        env.processes['w']['beat'] = beat = util.supervisor_process('celery-beat')
+        self.assertEqual(util.get_processes('b', ['beat']), [beat])
+        env.hostinfo['a']['w'] = True
+        self.assertEqual(util.get_processes('a'), [self.django])
+        server_settings.build_index()
+        self.assertItemsEqual(util.get_processes('a'), [self.django, self.worker, beat])
+        del env.hostinfo['b']['w']
+        server_settings.build_index()
+        self.assertEqual(server_settings.get_roles_for_host('b'), ['app-server'])
+
+    def test_misspelled(self):
+        with self.assertRaises(Exception) as context:
+            util.get_processes('a', ['djnago'])
+        self.assertIn('did you mean django?', str(context.exception))
@@ -0,0 +1,13 @@
+from django.conf.urls import url
+
+from tests import views
+
+urlpatterns = [
+    url(r'^page/$', views.page),
+    url(r'^tagged/$', views.tagged),
+    url(r'^failing/$', views.failing),
+    url(r'^fragment/$', views.fragment_page),
+    url(r'^login/$', views.login),
+    url(r'^user/$', views.user_page),
+    url(r'^form/$', views.form_page),
+]
@@ -0,0 +1,56 @@
+import time
+
+from django.http import HttpResponse
+from django.shortcuts import render
+
+from protecomp.middleware.cache import share_response, tag_response
+
+
+def page(request):
+    """A page of 2000 bytes. The query parameters delay the response by
+    delay seconds and set its max_age."""
+    time.sleep(float(request.GET.get('delay', 0)))
+    response = HttpResponse('<html>%s</html>' % ('x' * 2000))
+    if 'max_age' in request.GET:
+        response['Cache-Control'] = 'max-age=%s' % request.GET['max_age']
+    return response
+
+
+def tagged(request):
+    """page() tagged with the tag query parameters"""
+    return tag_response(page(request), *request.GET.getlist('tag'))
+
+
+failing_calls = []
+
+
+def failing(request):
+    """Records the call in failing_calls and raises ValueError"""
+    failing_calls.append(request.method)
+    raise ValueError('failing view')
+
+
+def fragment_page(request):
+    """A page with a fragment greeting the user of the session and a user
+    comment, shared between the sessions with the share query parameter"""
+    response = render(request, 'fragment_page.html', {
+        'text': 'x' * 2000, 'comment': request.GET.get('comment', '')})
+    if 'share' in request.GET:
+        share_response(response)
+    return response
+
+
+def user_page(request):
+    """A page with a login box fragment, and the user name outside it"""
+    return render(request, 'user_page.html', {'text': 'x' * 2000})
+
+
+def form_page(request):
+    """A page with a form and its CSRF token"""
+    return render(request, 'form_page.html', {'text': 'x' * 2000})
+
+
+def login(request):
+    """Stores the name query parameter in the session"""
+    request.session['name'] = request.GET['name']
+    return HttpResponse('ok')